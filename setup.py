@@ -54,6 +54,9 @@ version = get_version("universal_notifications")
 requirements = local_open("requirements/requirements-base.txt")
 required_to_install = [dist.strip() for dist in requirements.readlines()]
 
+apns_http2_requirements = local_open("requirements/requirements-apns-http2.txt")
+apns_http2_to_install = [dist.strip() for dist in apns_http2_requirements.readlines()]
+
 
 setup(
     name="universal_notifications",
@@ -68,6 +71,7 @@ setup(
     package_data=get_package_data("universal_notifications"),
     zip_safe=False,
     install_requires=required_to_install,
+    extras_require={"apns-http2": apns_http2_to_install},
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Environment :: Web Environment",
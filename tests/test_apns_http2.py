@@ -0,0 +1,174 @@
+import asyncio
+import json
+import socket
+import threading
+
+import h2.config
+import h2.connection
+import h2.events
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
+from rest_framework.test import APITestCase
+from universal_notifications.backends.push.apns import apns_send_bulk_message, apns_send_message
+from universal_notifications.backends.push.apns_http2 import APNSHTTP2Error
+from universal_notifications.backends.push.utils import PushTimeout
+from universal_notifications.models import Device
+
+
+class APNSStandInServer(object):
+    """Local HTTP/2 (prior knowledge, no TLS) server responding like APNS:
+    tokens starting with "bad" are rejected, tokens starting with "gone" are unregistered."""
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.host = "http://127.0.0.1:{}".format(self.sock.getsockname()[1])
+        self.connections = 0
+        self.requests = []
+        self.slow_released = threading.Event()  # responses to "slow" tokens are sent after close()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def close(self):
+        self.slow_released.set()
+        self.sock.close()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def get_response(self, path):
+        token = path.rsplit("/", 1)[-1]
+        if token.startswith("slow"):
+            self.slow_released.wait(5)
+        if token.startswith("bad"):
+            return 400, {"reason": "BadDeviceToken"}
+        if token.startswith("gone"):
+            return 410, {"reason": "Unregistered", "timestamp": 1}
+        return 200, None
+
+    def handle(self, connection):
+        h2_connection = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        h2_connection.initiate_connection()
+        connection.sendall(h2_connection.data_to_send())
+        streams = {}
+        with connection:
+            while True:
+                try:
+                    data = connection.recv(65535)
+                except OSError:
+                    return
+                if not data:
+                    return
+                for event in h2_connection.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        streams[event.stream_id] = {"headers": {k.decode(): v.decode() for k, v in event.headers},
+                                                    "body": b""}
+                    elif isinstance(event, h2.events.DataReceived):
+                        streams[event.stream_id]["body"] += event.data
+                        h2_connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        request = streams.pop(event.stream_id)
+                        self.requests.append(request)
+                        status, body = self.get_response(request["headers"][":path"])
+                        body = json.dumps(body).encode("utf-8") if body else b""
+                        h2_connection.send_headers(event.stream_id, [(":status", str(status)),
+                                                                     ("content-length", str(len(body)))],
+                                                   end_stream=not body)
+                        if body:
+                            h2_connection.send_data(event.stream_id, body, end_stream=True)
+                try:
+                    connection.sendall(h2_connection.data_to_send())
+                except OSError:  # client gave up (timeout)
+                    return
+
+
+class APNSHTTP2Tests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", email="user@example.com", password="1234")
+        self.server = APNSStandInServer()
+        self.addCleanup(self.server.close)
+
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        self.public_key = private_key.public_key()
+        self.app_settings = {
+            "APNS_AUTH_KEY": private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                                       serialization.NoEncryption()).decode("utf-8"),
+            "APNS_AUTH_KEY_ID": "KEY123",
+            "APNS_TEAM_ID": "TEAM123",
+            "APNS_TOPIC": "com.example.app",
+            "APNS_HTTP2_HOST": self.server.host,
+        }
+
+    def get_device(self, token):
+        return Device(user=self.user, app_id="app1", platform=Device.PLATFORM_IOS, notification_token=token)
+
+    def test_send_bulk(self):
+        devices = [self.get_device(token) for token in ["aaa1", "bad1", "aaa2", "gone1", "aaa3"]]
+        with override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS={"app1": self.app_settings},
+                               UNIVERSAL_NOTIFICATIONS_APNS_HTTP2_CONCURRENCY=2):
+            results = apns_send_bulk_message(devices, "msg", "desc", {"badge": 1, "expiration": 30})
+
+        self.assertEqual([x.status if x else None for x in results], [None, 400, None, 410, None])
+        self.assertIsInstance(results[1], APNSHTTP2Error)
+        self.assertEqual(results[1].reason, "BadDeviceToken")
+        self.assertEqual(results[3].reason, "Unregistered")
+
+        # all notifications are multiplexed over one connection
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(sorted(x["headers"][":path"] for x in self.server.requests),
+                         sorted("/3/device/{}".format(x.notification_token) for x in devices))
+
+        request = self.server.requests[0]
+        self.assertEqual(json.loads(request["body"]), {"aps": {"alert": {"body": "desc", "title": "msg"}, "badge": 1}})
+        self.assertEqual(request["headers"]["apns-topic"], "com.example.app")
+        self.assertEqual(request["headers"]["apns-push-type"], "alert")
+        self.assertEqual(request["headers"]["apns-expiration"], "30")
+        self.assertEqual(request["headers"]["apns-priority"], "10")
+        token = request["headers"]["authorization"].split(" ", 1)[1]
+        self.assertEqual(jwt.get_unverified_header(token)["kid"], "KEY123")
+        self.assertEqual(jwt.decode(token, self.public_key, algorithms=["ES256"])["iss"], "TEAM123")
+
+    def test_send_background(self):
+        with override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS={"app1": self.app_settings}):
+            results = apns_send_bulk_message([self.get_device("aaa1")], data={"content_available": True})
+        self.assertEqual(results, [None])
+        headers = self.server.requests[0]["headers"]
+        self.assertEqual((headers["apns-push-type"], headers["apns-priority"]), ("background", "5"))
+
+    def test_send_from_event_loop(self):
+        async def send():
+            return apns_send_bulk_message([self.get_device("aaa1"), self.get_device("bad1")], "msg")
+
+        with override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS={"app1": self.app_settings}):
+            results = asyncio.run(send())
+        self.assertEqual([x.status if x else None for x in results], [None, 400])
+
+    def test_send_bulk_timeout(self):
+        devices = [self.get_device(token) for token in ["slow1", "slow2"]]
+        with override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS={"app1": self.app_settings}):
+            results = apns_send_bulk_message(devices, "msg", timeout=0.2)
+        self.assertEqual([type(x) for x in results], [PushTimeout, PushTimeout])
+
+    def test_send_message(self):
+        with override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS={"app1": self.app_settings}):
+            apns_send_message(self.get_device("aaa1"), "msg")
+            self.assertEqual(json.loads(self.server.requests[0]["body"]), {"aps": {"alert": {"body": "msg"}}})
+
+            with self.assertRaises(APNSHTTP2Error):
+                apns_send_message(self.get_device("bad1"), "msg")
+
+        app_settings = dict(self.app_settings, APNS_TOPIC=None)
+        with override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS={"app1": app_settings}):
+            with self.assertRaises(ImproperlyConfigured):
+                apns_send_message(self.get_device("aaa1"), "msg")
@@ -1,17 +1,27 @@
 import json
 import os
+import socket
+import struct
+import threading
+from http.client import RemoteDisconnected
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 from unittest import mock
 from django.contrib.auth.models import User
 from django.core.exceptions import ImproperlyConfigured
 from django.test.utils import override_settings
 from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS
+from pyfcm.errors import FCMServerError
+from requests.exceptions import ConnectionError, Timeout
 from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase
-from universal_notifications.backends.push.apns import APNSDataOverflow, apns_send_message
-from universal_notifications.backends.push.fcm import fcm_send_message
-from universal_notifications.backends.push.gcm import gcm_send_message
-from universal_notifications.backends.websockets import publish
+from universal_notifications.backends.push.apns import (APNSDataOverflow, APNSError, APNSServerError,
+                                                        apns_send_bulk_message, apns_send_message, connection_pool)
+from universal_notifications.backends.push.dispatch import PushTimeout, send_bulk_message
+from universal_notifications.backends.push.fcm import fcm_send_bulk_message, fcm_send_message
+from universal_notifications.backends.push.gcm import (GCMConnection, GCMError, gcm_send_bulk_message,
+                                                       gcm_send_message)
+from universal_notifications.backends.websockets import publish, publish_bulk
 from universal_notifications.models import Device
 
 try:
@@ -62,6 +72,26 @@ class WSTests(APITestCase):
             result.update(additional_data)
             mocked_message.assert_called_with(JSONRenderer().render(result))
 
+    @override_settings(TESTING=False, UNIVERSAL_NOTIFICATIONS_WS_PIPELINE_SIZE=2)
+    def test_publish_bulk(self):
+        users = [SampleUser("user{}@example.com".format(i)) for i in range(3)]
+        with mock.patch("universal_notifications.backends.websockets.StrictRedis") as mocked_redis, \
+                mock.patch("universal_notifications.backends.websockets.JSONRenderer",
+                           wraps=JSONRenderer) as mocked_renderer, \
+                mock.patch("ws4redis.settings.WS4REDIS_EXPIRE", 10):
+            pipeline = mocked_redis.return_value.pipeline.return_value
+            publish_bulk(users + users[:1], self.item, {"additional": True})
+
+            # serialized once, sent with one connection in 2 pipelines
+            self.assertEqual(mocked_renderer.call_count, 1)
+            mocked_redis.assert_called_once()
+            self.assertEqual(pipeline.execute.call_count, 2)
+            message = JSONRenderer().render(dict(self.item.as_dict(), additional=True))
+            self.assertEqual(sorted(pipeline.publish.call_args_list), sorted(
+                mock.call("user:{}:all".format(x.email), message) for x in users))
+            self.assertEqual(sorted(pipeline.setex.call_args_list), sorted(
+                mock.call("user:{}:all".format(x.email), 10, message) for x in users))
+
 
 class PushTests(APITestCase):
     test_settings = {
@@ -96,6 +126,49 @@ class PushTests(APITestCase):
             mocked_notify.assert_called_with(registration_id=message["device"].notification_token,
                                              message_body=message["message"], data_message=message["data"])
 
+    @override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS=dict(test_settings, app2={}),
+                       UNIVERSAL_NOTIFICATIONS_FCM_BATCH_SIZE=2)
+    def test_fcm_bulk(self):
+        devices = [Device(user=self.user, app_id="app1", platform=Device.PLATFORM_FCM,
+                          notification_token="token{}".format(i)) for i in range(5)]
+        devices[1].is_active = False
+        devices.insert(2, Device(user=self.user, app_id="app2", platform=Device.PLATFORM_FCM, notification_token="x"))
+
+        def notify(registration_ids, **kwargs):
+            return {"results": [{"error": "NotRegistered"} if x == "token3" else {"message_id": x}
+                                for x in registration_ids]}
+
+        with mock.patch("universal_notifications.backends.push.fcm.FCMNotification") as mocked_fcm:
+            mocked_fcm.FCM_MAX_RECIPIENTS = 1000
+            mocked_fcm.return_value.notify_multiple_devices.side_effect = notify
+            results = fcm_send_bulk_message(devices, "msg", {"stuff": "foo"})
+
+            mocked_fcm.assert_called_once_with(api_key="secret")
+            self.assertEqual(mocked_fcm.return_value.notify_multiple_devices.call_args_list, [
+                mock.call(registration_ids=["token0", "token2"], message_body="msg", data_message={"stuff": "foo"}),
+                mock.call(registration_ids=["token3", "token4"], message_body="msg", data_message={"stuff": "foo"}),
+            ])
+        self.assertEqual(results, [{"message_id": "token0"}, None, None, {"message_id": "token2"},
+                                   {"error": "NotRegistered"}, {"message_id": "token4"}])
+
+        # requests are limited to the time left, timed out requests do not stop sending
+        with mock.patch("universal_notifications.backends.push.fcm.FCMNotification") as mocked_fcm:
+            mocked_fcm.FCM_MAX_RECIPIENTS = 1000
+            mocked_fcm.return_value.notify_multiple_devices.side_effect = [Timeout(), notify(["token3", "token4"])]
+            results = fcm_send_bulk_message(devices, "msg", timeout=10)
+            timeout = mocked_fcm.return_value.notify_multiple_devices.call_args[1]["timeout"]
+            self.assertTrue(0 < timeout <= 10)
+        self.assertEqual([type(x) for x in results], [PushTimeout, type(None), type(None), PushTimeout, dict, dict])
+
+        # failed requests do not stop sending to other devices either
+        server_error, connection_error = FCMServerError("Internal error"), ConnectionError("refused")
+        with mock.patch("universal_notifications.backends.push.fcm.FCMNotification") as mocked_fcm:
+            mocked_fcm.FCM_MAX_RECIPIENTS = 1000
+            mocked_fcm.return_value.notify_multiple_devices.side_effect = [server_error, connection_error]
+            results = fcm_send_bulk_message(devices, "msg")
+            self.assertEqual(mocked_fcm.return_value.notify_multiple_devices.call_count, 2)
+        self.assertEqual(results, [server_error, None, None, server_error, connection_error, connection_error])
+
     @mock.patch("universal_notifications.backends.push.gcm.urlopen")
     def test_gcm(self, mocked_urlopen):
         message = {
@@ -142,6 +215,110 @@ class PushTests(APITestCase):
             mocked_urlopen.return_value.read.return_value = "Error=Fail"
             self.assertFalse(gcm_send_message(**message))
 
+    def test_gcm_bulk(self):
+        requests = []
+        connections = []
+
+        class GCMHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                connections.append(self.client_address)
+                super(GCMHandler, self).setup()
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                requests.append((self.headers["Authorization"], request))
+                if self.headers["Authorization"] == "key=slow":
+                    slow_released.wait(5)
+                status = 401 if self.headers["Authorization"] == "key=wrong" else 200
+                body = json.dumps({"results": [{"error": "NotRegistered"} if x == "token3" else {"message_id": x}
+                                               for x in request["registration_ids"]]}).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), GCMHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        slow_released = threading.Event()  # slow requests are answered after the test
+        self.addCleanup(slow_released.set)
+
+        devices = [Device(user=self.user, app_id="app1", platform=Device.PLATFORM_GCM,
+                          notification_token="token{}".format(i)) for i in range(5)]
+        devices[1].is_active = False
+        url = "http://127.0.0.1:{}/gcm/send".format(server.server_address[1])
+        with mock.patch.dict(PUSH_NOTIFICATIONS_SETTINGS, GCM_POST_URL=url):
+            with override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS=self.test_settings,
+                                   UNIVERSAL_NOTIFICATIONS_GCM_BATCH_SIZE=2):
+                results = gcm_send_bulk_message(devices, "msg", {"info": "foo"}, collapse_key="key", time_to_live="1")
+            self.assertEqual(results, [{"message_id": "token0"}, None, {"message_id": "token2"},
+                                       {"error": "NotRegistered"}, {"message_id": "token4"}])
+            # one keep-alive connection for all requests
+            self.assertEqual(len(connections), 1)
+            self.assertEqual(requests, [
+                ("key=secret", {"data": {"info": "foo", "message": "msg"}, "collapse_key": "key", "time_to_live": 1,
+                                "registration_ids": ["token0", "token2"]}),
+                ("key=secret", {"data": {"info": "foo", "message": "msg"}, "collapse_key": "key", "time_to_live": 1,
+                                "registration_ids": ["token3", "token4"]}),
+            ])
+
+            # failed requests & apps without keys do not stop sending to other devices
+            devices[4].app_id = "app2"
+            apps = {"app1": {"GCM_API_KEY": "wrong"}, "app2": {"GCM_API_KEY": "secret"}}
+            with override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS=apps):
+                results = gcm_send_bulk_message(devices, "msg")
+            self.assertEqual([type(x) for x in results], [GCMError, type(None), GCMError, GCMError, dict])
+            self.assertEqual(results[0].args[0], 401)
+            self.assertEqual(results[4], {"message_id": "token4"})
+
+            with override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS={"app1": {}, "app2": {"GCM_API_KEY": "secret"}}):
+                results = gcm_send_bulk_message(devices, "msg")
+            self.assertIsInstance(results[0], ImproperlyConfigured)
+            self.assertEqual(results[4], {"message_id": "token4"})
+
+            # requests are limited to the timeout
+            with override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS={"app1": {"GCM_API_KEY": "slow"}}):
+                with mock.patch.object(GCMConnection, "set_timeout", autospec=True,
+                                       side_effect=GCMConnection.set_timeout) as mocked_set_timeout:
+                    results = gcm_send_bulk_message(devices[:1], "msg", timeout=0.1)
+                self.assertTrue(0 < mocked_set_timeout.call_args[0][1] <= 0.1)
+            self.assertIsInstance(results[0], PushTimeout)
+
+    def test_gcm_connection_retry(self):
+        connection = GCMConnection("http://127.0.0.1/gcm/send")
+        with mock.patch.object(connection, "connection") as mocked_connection:
+            mocked_connection.getresponse.return_value.status = 200
+            mocked_connection.getresponse.return_value.read.return_value = b"{}"
+
+            # kept-alive connection closed by the server, the request has not been sent
+            mocked_connection.request.side_effect = [BrokenPipeError(), None]
+            self.assertEqual(connection.post(b"{}", {}), (200, b"{}"))
+            self.assertEqual(mocked_connection.request.call_count, 2)
+
+            # new connection failed
+            mocked_connection.reset_mock()
+            mocked_connection.sock = None
+            mocked_connection.request.side_effect = ConnectionRefusedError()
+            with self.assertRaises(ConnectionRefusedError):
+                connection.post(b"{}", {})
+            self.assertEqual(mocked_connection.request.call_count, 1)
+
+            # the request may have been received - it is not sent again
+            mocked_connection.reset_mock()
+            mocked_connection.sock = mock.Mock()
+            mocked_connection.request.side_effect = None
+            mocked_connection.getresponse.side_effect = RemoteDisconnected()
+            with self.assertRaises(RemoteDisconnected):
+                connection.post(b"{}", {})
+            self.assertEqual(mocked_connection.request.call_count, 1)
+            mocked_connection.close.assert_called_once_with()
+
     def test_apns_config(self):
         message = {
             "device": self.apns_device,
@@ -168,12 +345,108 @@ class PushTests(APITestCase):
         }
 
         with mock.patch("ssl.wrap_socket") as ws:
-            with mock.patch("socket.socket") as socket:
+            with mock.patch("socket.socket") as socket, mock.patch("select.select", return_value=([], [], [])):
                 with override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS=self.test_settings):
                     socket.return_value = 123
-                    apns_send_message(**message)
+                    try:
+                        apns_send_message(**message)
+                        # connection is reused
+                        apns_send_message(**message)
+                    finally:
+                        connection_pool.close()
                     ws.assert_called_once_with(
                         123, certfile=self.test_settings["app1"]["APNS_CERTIFICATE"], ssl_version=3)
+                    self.assertEqual(ws.return_value.sendall.call_count, 2)
+
+    @override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS=test_settings, UNIVERSAL_NOTIFICATIONS_APNS_BATCH_SIZE=2)
+    def test_apns_bulk(self):
+        devices = [Device(user=self.user, app_id="app1", platform=Device.PLATFORM_IOS,
+                          notification_token="{:064x}".format(i)) for i in range(5)]
+        sockets = [socket.socketpair() for i in range(3)]
+        # APNS rejects the second notification, notifications sent after it are dropped
+        sockets[0][1].sendall(struct.pack("!BBI", 8, 8, 1))
+
+        def read_tokens(sock):
+            sock.setblocking(False)
+            data = sock.recv(65536)
+            tokens = []
+            while data:
+                frame_len = struct.unpack("!I", data[1:5])[0]
+                tokens.append(data[8:40].hex())
+                data = data[5 + frame_len:]
+            return tokens
+
+        try:
+            with mock.patch("universal_notifications.backends.push.apns._apns_create_socket_to_push",
+                            side_effect=[x[0] for x in sockets]) as mocked_create:
+                results = apns_send_bulk_message(devices, "msg", "desc")
+                self.assertEqual(mocked_create.call_count, 2)
+                self.assertIsNone(results[0])
+                self.assertIsInstance(results[1], APNSServerError)
+                self.assertEqual(results[1].status, 8)
+                self.assertEqual(results[2:], [None, None, None])
+                # first batch has been written before the error was read
+                self.assertEqual(read_tokens(sockets[0][1]), [x.notification_token for x in devices[:2]])
+                self.assertEqual(read_tokens(sockets[1][1]), [x.notification_token for x in devices[2:]])
+
+                # connection is reused
+                self.assertEqual(apns_send_bulk_message(devices[:1], "msg"), [None])
+                self.assertEqual(mocked_create.call_count, 2)
+                self.assertEqual(read_tokens(sockets[1][1]), [devices[0].notification_token])
+        finally:
+            connection_pool.close()
+            for pair in sockets:
+                pair[1].close()
+
+    @override_settings(UNIVERSAL_NOTIFICATIONS_APNS_BATCH_SIZE=2)
+    def test_apns_bulk_timeout(self):
+        devices = [Device(user=self.user, app_id="app1", platform=Device.PLATFORM_IOS,
+                          notification_token="{:064x}".format(i)) for i in range(5)]
+        sockets = socket.socketpair()
+        remaining = [10, 0]  # second batch is not written before the deadline
+
+        def get_remaining_time(deadline, default=None):
+            return remaining.pop(0) if default is None else default
+
+        try:
+            with mock.patch("universal_notifications.backends.push.apns._apns_create_socket_to_push",
+                            return_value=sockets[0]), \
+                    mock.patch("universal_notifications.backends.push.apns.get_remaining_time", get_remaining_time):
+                results = apns_send_bulk_message(devices, "msg", timeout=10)
+            self.assertEqual(results[:2], [None, None])
+            self.assertEqual([type(x) for x in results[2:]], [PushTimeout] * 3)
+            # only the first batch has been written
+            data = sockets[1].recv(65536)
+            frame_len = struct.unpack("!I", data[1:5])[0]
+            self.assertEqual(len(data), 2 * (5 + frame_len))
+        finally:
+            connection_pool.close()
+            sockets[1].close()
+
+    @override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS=dict(test_settings, app2=test_settings["app1"]),
+                       UNIVERSAL_NOTIFICATIONS_APNS_BATCH_SIZE=2)
+    def test_apns_bulk_connection_failure(self):
+        devices = [Device(user=self.user, app_id="app1" if i < 3 else "app2", platform=Device.PLATFORM_IOS,
+                          notification_token="{:064x}".format(i)) for i in range(5)]
+        sockets = [socket.socketpair() for i in range(2)]
+        sockets[0][1].close()  # connection of app1 is closed by APNS without an error response
+
+        try:
+            with mock.patch("universal_notifications.backends.push.apns._apns_create_socket_to_push",
+                            side_effect=[x[0] for x in sockets]):
+                results = apns_send_bulk_message(devices, "msg")
+            # notifications of app1 have not been confirmed, notifications of app2 are still sent
+            self.assertEqual([type(x) for x in results[:3]], [APNSError] * 3)
+            self.assertEqual(results[3:], [None, None])
+
+            # writes timed out before the deadline
+            with mock.patch("universal_notifications.backends.push.apns.APNSConnection.write",
+                            side_effect=socket.timeout()):
+                results = apns_send_bulk_message(devices[3:], "msg", timeout=10)
+            self.assertEqual([type(x) for x in results], [PushTimeout] * 2)
+        finally:
+            connection_pool.close()
+            sockets[1][1].close()
 
     @override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS=test_settings)
     @mock.patch("universal_notifications.backends.push.apns._apns_pack_frame")
@@ -214,20 +487,108 @@ class PushTests(APITestCase):
             "custom_data": 12345
         }
         expected_payload = json.dumps(expected_payload, separators=(",", ":"), sort_keys=True).encode("utf-8")
-        # test rich payload
-        apns_send_message(**message)
-        mock_pack_frame.assert_called_with(
-            self.apns_device.notification_token, expected_payload,
-            message["data"]["identifier"], message["data"]["expiration"], message["data"]["priority"]
-        )
-
-        # test sending without description
-        with mock.patch("universal_notifications.backends.push.apns._apns_send") as mocked_send:
+        # test rich payload (identifiers are given to frames by _apns_send_frames)
+        with mock.patch("universal_notifications.backends.push.apns._apns_send_frames",
+                        return_value={}) as mocked_send_frames:
+            apns_send_message(**message)
+            mock_pack_frame.assert_called_with(
+                self.apns_device.notification_token, expected_payload,
+                0, message["data"]["expiration"], message["data"]["priority"]
+            )
+            mocked_send_frames.assert_called_once_with(self.apns_device.app_id, [mock_pack_frame.return_value], None)
+
+            # test sending without description
             apns_send_message(self.apns_device, message="msg", description="")
-            mocked_send.assert_called_with(self.apns_device.app_id, self.apns_device.notification_token, {
-                "body": "msg"
-            })
+            payload = json.dumps({"aps": {"alert": {"body": "msg"}}}, separators=(",", ":")).encode("utf-8")
+            mock_pack_frame.assert_called_with(self.apns_device.notification_token, payload, 0, mock.ANY, 10)
+
+            # background notifications are sent with priority 5
+            apns_send_message(self.apns_device, data={"content_available": True})
+            self.assertEqual(mock_pack_frame.call_args[0][4], 5)
+
+            # errors are raised
+            mocked_send_frames.return_value = {0: APNSServerError(8, 0)}
+            with self.assertRaises(APNSServerError):
+                apns_send_message(self.apns_device, "msg")
 
         # test oversizing
         with self.assertRaises(APNSDataOverflow):
             apns_send_message(self.apns_device, "_" * 2049)
+
+
+class DispatchTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", email="user@example.com", password="1234")
+
+    def test_send_bulk_message(self):
+        devices = [Device(user=self.user, app_id="app1", platform=platform, notification_token=str(i))
+                   for i, platform in enumerate([Device.PLATFORM_IOS, Device.PLATFORM_FCM, Device.PLATFORM_GCM,
+                                                 Device.PLATFORM_FCM, Device.PLATFORM_IOS, "unknown"])]
+        devices[4].is_active = False
+        with mock.patch("universal_notifications.backends.push.dispatch.apns_send_bulk_message",
+                        return_value=["apns0"]) as mocked_apns, \
+                mock.patch("universal_notifications.backends.push.dispatch.fcm_send_bulk_message",
+                           return_value=["fcm1", "fcm3"]) as mocked_fcm, \
+                mock.patch("universal_notifications.backends.push.dispatch.gcm_send_bulk_message",
+                           return_value=["gcm2"]) as mocked_gcm:
+            results = send_bulk_message(devices, "msg", "desc", badge=1)
+
+        mocked_apns.assert_called_once_with([devices[0]], "msg", "desc", {"badge": 1}, timeout=None)
+        mocked_fcm.assert_called_once_with([devices[1], devices[3]], "msg", {"badge": 1}, timeout=None)
+        mocked_gcm.assert_called_once_with([devices[2]], "msg", {"badge": 1}, timeout=None)
+        self.assertEqual(results, ["apns0", "fcm1", "gcm2", "fcm3", False, False])
+
+    @override_settings(UNIVERSAL_NOTIFICATIONS_PUSH_CONCURRENT=True, UNIVERSAL_NOTIFICATIONS_PUSH_DISPATCH_BATCH_SIZE=2,
+                       UNIVERSAL_NOTIFICATIONS_PUSH_CONCURRENCY={Device.PLATFORM_FCM: 1},
+                       UNIVERSAL_NOTIFICATIONS_PUSH_TIMEOUTS={Device.PLATFORM_GCM: 0.1})
+    def test_send_bulk_message_concurrently(self):
+        devices = [Device(user=self.user, app_id="app1", platform=platform, notification_token=str(i))
+                   for i, platform in enumerate([Device.PLATFORM_IOS, Device.PLATFORM_FCM, Device.PLATFORM_FCM,
+                                                 Device.PLATFORM_FCM, Device.PLATFORM_GCM])]
+        running = {Device.PLATFORM_FCM: 0}
+        max_running = {Device.PLATFORM_FCM: 0}
+        lock = threading.Lock()
+        gcm_started = threading.Event()
+        gcm_released = threading.Event()
+        self.addCleanup(gcm_released.set)
+        apns_sent_with_gcm = []
+        timeouts = {}
+
+        def send_apns(devices, message, description, data, timeout):
+            timeouts[Device.PLATFORM_IOS] = timeout
+            apns_sent_with_gcm.append(gcm_started.wait(5))
+            return ["apns"] * len(devices)
+
+        def send_fcm(devices, message, data, timeout):
+            with lock:
+                running[Device.PLATFORM_FCM] += 1
+                max_running[Device.PLATFORM_FCM] = max(max_running[Device.PLATFORM_FCM], running[Device.PLATFORM_FCM])
+            gcm_started.wait(5)
+            with lock:
+                running[Device.PLATFORM_FCM] -= 1
+            if devices[0].notification_token == "3":
+                raise ValueError("fcm error")
+            return ["fcm"] * len(devices)
+
+        def send_gcm(devices, message, data, timeout):
+            timeouts[Device.PLATFORM_GCM] = timeout
+            gcm_started.set()
+            gcm_released.wait(5)  # does not return within the platform timeout
+            return ["gcm"] * len(devices)
+
+        with mock.patch("universal_notifications.backends.push.dispatch.apns_send_bulk_message", send_apns), \
+                mock.patch("universal_notifications.backends.push.dispatch.fcm_send_bulk_message", send_fcm), \
+                mock.patch("universal_notifications.backends.push.dispatch.gcm_send_bulk_message", send_gcm):
+            results = send_bulk_message(devices, "msg")
+
+        # platforms are sent in parallel - gcm was being sent while apns was sending
+        self.assertEqual(apns_sent_with_gcm, [True])
+        self.assertEqual(results[:3], ["apns", "fcm", "fcm"])
+        self.assertIsInstance(results[3], ValueError)
+        # gcm timed out
+        self.assertIsInstance(results[4], PushTimeout)
+        # fcm batches were sent one after another
+        self.assertEqual(max_running[Device.PLATFORM_FCM], 1)
+        # platform timeouts are passed to the senders
+        self.assertTrue(29 < timeouts[Device.PLATFORM_IOS] <= 30)
+        self.assertTrue(0 < timeouts[Device.PLATFORM_GCM] <= 0.1)
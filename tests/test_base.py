@@ -7,20 +7,37 @@
     - sending
 """
 import json
+import sys
+import types
+from email.utils import formataddr
 from random import randint
+from smtplib import SMTPServerDisconnected
 
 from unittest import mock
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
 from django.core import mail
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connection as db_connection
 from django.db import models
+from django.template import Template
+from django.template.loader import get_template
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from premailer import Premailer
 from rest_framework import serializers
 from rest_framework.test import APITestCase
+from tests import user_conf
+from universal_notifications.backends.emails.inline_css import (clear_inlined_templates_cache, get_static_cache_paths,
+                                                                is_inlinable)
+from universal_notifications.backends.websockets import get_message
 from universal_notifications.models import Device, NotificationHistory, UnsubscribedUser
 from universal_notifications.notifications import (EmailNotification, PushNotification, SMSNotification,
-                                                   WSNotification)
+                                                   WSNotification, _user_types_cache)
+from universal_notifications.tasks import send_notification_chunk_task
+from universal_notifications.utils import clear_template_cache, get_template_cache_info
 
 
 class SampleModel(models.Model):
@@ -156,9 +173,10 @@ class BaseTest(APITestCase):
             mocked_send_inner.assert_called_with({self.object_receiver}, expected_message)
 
         # test send_inner
-        with mock.patch("universal_notifications.notifications.publish") as mocked_publish:
+        with mock.patch("universal_notifications.notifications.publish_bulk") as mocked_publish:
             SampleD(self.object_item, [self.object_receiver], {}).send()
-            mocked_publish.assert_called_with(self.object_receiver, additional_data=expected_message)
+            mocked_publish.assert_called_with({self.object_receiver},
+                                              message=get_message(additional_data=expected_message))
 
         # test SMSNotifications
         sms_message = "{}: {}".format(self.object_receiver.email, self.object_item.name)
@@ -228,9 +246,10 @@ class BaseTest(APITestCase):
             mocked_send_inner.assert_called_with({self.object_receiver}, expected_message)
 
         # test send_inner
-        with mock.patch("tests.test_base.Device.send_message") as mocked_send_message:
+        with mock.patch("universal_notifications.notifications.send_bulk_message") as mocked_send_message:
             SampleG(self.object_item, [self.regular_user], {"item": self.object_item}).send()
-            mocked_send_message.assert_called_with(self.object_item.name, SampleG.description)
+            self.assertEqual(list(mocked_send_message.call_args[0][0]), [self.push_device])
+            self.assertEqual(mocked_send_message.call_args[0][1:], (self.object_item.name, SampleG.description))
 
         # test w/o category - should fail
         with mock.patch("tests.test_base.SampleNoCategory.send_inner") as mocked_send_inner:
@@ -252,6 +271,360 @@ class BaseTest(APITestCase):
             with self.assertRaises(ImproperlyConfigured):
                 SampleNotExistingCategory(self.object_item, [self.object_receiver], {}).send()
 
+    def test_sms_template_compiled_once(self):
+        receivers = [SampleReceiver("foo{}@bar.com".format(i), "12345678{}".format(i)) for i in range(3)]
+        clear_template_cache()
+        with mock.patch("universal_notifications.notifications.send_sms") as mocked_send_sms:
+            with mock.patch("universal_notifications.utils.Template", wraps=Template) as mocked_template:
+                SampleE(self.object_item, receivers, {}).send()
+                SampleE(self.object_item, receivers, {}).send()
+                self.assertEqual(mocked_template.call_count, 1)
+
+            sent = sorted(call[0] for call in mocked_send_sms.call_args_list)
+            self.assertEqual(sent, sorted(
+                (r.phone, "{}: {}".format(r.email, self.object_item.name)) for r in receivers * 2))
+
+    def test_sms_context_per_receiver(self):
+        class SamplePrepareMessage(SampleE):
+            def prepare_message(self):
+                return "Hi {}".format(self.context["receiver"].email if "receiver" in self.context else "")
+
+        class SampleReceiverContext(SampleE):
+            message = "{{ greeting }}"
+
+            def get_context(self):
+                context = super(SampleReceiverContext, self).get_context()
+                context["greeting"] = "Hello {}".format(context["receiver"].email if "receiver" in context else "")
+                return context
+
+        receivers = [SampleReceiver("foo{}@bar.com".format(i), "12345678{}".format(i)) for i in range(3)]
+        for notification_class, text in ((SamplePrepareMessage, "Hi {}"), (SampleReceiverContext, "Hello {}")):
+            with mock.patch("universal_notifications.notifications.send_sms") as mocked_send_sms:
+                notification_class(self.object_item, receivers, {}).send()
+            sent = sorted(call[0] for call in mocked_send_sms.call_args_list)
+            self.assertEqual(sent, sorted((r.phone, text.format(r.email)) for r in receivers))
+
+    def test_template_cache(self):
+        clear_template_cache()
+        with mock.patch("tests.test_base.SampleG.send_inner"):
+            SampleG(self.object_item, [self.object_receiver], {}).send()
+            first_cache_info = get_template_cache_info()
+            self.assertEqual((first_cache_info.misses, first_cache_info.currsize), (2, 2))
+
+            # title & description are not compiled again
+            SampleG(self.object_item, [self.object_receiver], {}).send()
+            cache_info = get_template_cache_info()
+            self.assertEqual((cache_info.misses, cache_info.currsize), (2, 2))
+            self.assertGreater(cache_info.hits, first_cache_info.hits)
+
+    @override_settings(UNIVERSAL_NOTIFICATIONS_SUBSCRIPTIONS_CHUNK_SIZE=2)
+    def test_subscriptions_filtering_in_chunks(self):
+        receivers = [self.regular_user, self.all_unsubscribed_receiver, self.unsubscribed_receiver,
+                     self.object_receiver, self.superuser_object_receiver]
+        with self.assertNumQueries(3):
+            notification = SampleI(self.object_item, receivers, {})
+            notification.verify_and_filter_receivers_subscriptions()
+        self.assertEqual(notification.receivers,
+                         [self.regular_user, self.object_receiver, self.superuser_object_receiver])
+
+    @override_settings(UNIVERSAL_NOTIFICATIONS_SUBSCRIPTIONS_CACHE_TIMEOUT=60)
+    def test_subscriptions_cache(self):
+        cache.clear()
+        receivers = [self.regular_user, self.all_unsubscribed_receiver, self.unsubscribed_receiver]
+        notification = SampleI(self.object_item, receivers, {})
+        notification.verify_and_filter_receivers_subscriptions()
+        self.assertEqual(notification.receivers, [self.regular_user])
+
+        # cached
+        with self.assertNumQueries(0):
+            notification = SampleI(self.object_item, receivers, {})
+            notification.verify_and_filter_receivers_subscriptions()
+            self.assertEqual(notification.receivers, [self.regular_user])
+
+        # invalidated on save
+        self.unsubscribed_user.unsubscribed = {}
+        self.unsubscribed_user.save()
+        notification = SampleI(self.object_item, receivers, {})
+        notification.verify_and_filter_receivers_subscriptions()
+        self.assertEqual(notification.receivers, [self.regular_user, self.unsubscribed_receiver])
+
+    def test_sending_in_chunks(self):
+        for i in range(3):
+            User.objects.create_user(username="chunk{}".format(i), email="chunk{}@foo.com".format(i), password="1234")
+        subscribed = list(User.objects.exclude(id__in=[self.all_unsubscribed_receiver.id,
+                                                       self.unsubscribed_receiver.id]))
+
+        class SampleChunked(SampleI):
+            receivers_chunk_size = 2
+
+        with mock.patch.object(SampleChunked, "send_inner") as mocked_send_inner:
+            result = SampleChunked(self.object_item, User.objects.order_by("id"), {}).send()
+            self.assertEqual(len(result), 3)  # 5 users in chunks of 2
+            sent = set()
+            for call in mocked_send_inner.call_args_list:
+                self.assertLessEqual(len(call[0][0]), 2)
+                sent.update(call[0][0])
+            self.assertEqual(sent, set(subscribed))
+        self.assertEqual(NotificationHistory.objects.count(), len(subscribed))
+
+        # generators are supported as well
+        mail.outbox = []
+        with override_settings(UNIVERSAL_NOTIFICATIONS_RECEIVERS_CHUNK_SIZE=2):
+            SampleI(self.object_item, (x for x in subscribed), {}).send()
+        self.assertEqual(len(mail.outbox), len(subscribed))
+
+        # and in regular mode
+        mail.outbox = []
+        SampleI(self.object_item, (x for x in subscribed), {}).send()
+        self.assertEqual(len(mail.outbox), len(subscribed))
+
+    def test_user_types(self):
+        receivers = [self.regular_user, self.regular_user, self.superuser_object_receiver]
+        self.assertEqual(SampleI.get_user_types(receivers), {
+            self.regular_user.id: "for_user",
+            self.superuser_object_receiver.id: "for_admin",
+        })
+
+        with mock.patch("tests.test_base.SampleI.send_inner"):
+            with mock.patch("tests.user_conf.for_admin", wraps=user_conf.for_admin) as mocked_for_admin:
+                # users are classified once per send
+                SampleI(self.object_item, receivers, {}).send()
+                self.assertEqual(mocked_for_admin.call_count, 2)
+                SampleI(self.object_item, receivers, {}).send()
+                self.assertEqual(mocked_for_admin.call_count, 4)
+
+                # and optionally cached per process
+                mocked_for_admin.reset_mock()
+                with override_settings(UNIVERSAL_NOTIFICATIONS_USER_TYPE_CACHE_TIMEOUT=60):
+                    SampleI(self.object_item, receivers, {}).send()
+                    SampleI(self.object_item, receivers, {}).send()
+                    self.assertEqual(mocked_for_admin.call_count, 2)
+
+                # cache is bounded - least recently used users are evicted
+                mocked_for_admin.reset_mock()
+                with override_settings(UNIVERSAL_NOTIFICATIONS_USER_TYPE_CACHE_TIMEOUT=60,
+                                       UNIVERSAL_NOTIFICATIONS_USER_TYPE_CACHE_SIZE=1):
+                    SampleI.get_user_types(receivers)
+                    self.assertEqual(list(_user_types_cache), [self.superuser_object_receiver.id])
+                    # each user evicted the other one
+                    SampleI.get_user_types(receivers)
+                    self.assertEqual(mocked_for_admin.call_count, 4)
+
+    def test_send_distributed(self):
+        item = self.regular_user
+        for i in range(3):
+            User.objects.create_user(username="task{}".format(i), email="task{}@foo.com".format(i), password="1234")
+        subscribed = User.objects.exclude(id__in=[self.all_unsubscribed_receiver.id, self.unsubscribed_receiver.id])
+
+        mail.outbox = []
+        with mock.patch("universal_notifications.tasks.send_notification_chunk_task.s",
+                        wraps=send_notification_chunk_task.s) as mocked_signature:
+            result = SampleI(item, User.objects.all(), {"param": "val"}).send_distributed(chunk_size=2)
+            self.assertEqual(mocked_signature.call_count, 3)
+            self.assertEqual(mocked_signature.call_args[0][3]["param"], "val")
+        self.assertEqual(sum(result.get()), subscribed.count())
+        self.assertEqual(sorted(x.to[0] for x in mail.outbox),
+                         sorted(SampleI.format_receiver(x) for x in subscribed))
+        self.assertEqual(NotificationHistory.objects.count(), subscribed.count())
+        self.assertEqual(NotificationHistory.objects.first().source, item)
+
+        # receivers are not replaced with the last chunk
+        receivers = User.objects.all()
+        notification = SampleI(item, receivers, {})
+        notification.send_distributed(chunk_size=2)
+        self.assertIs(notification.receivers, receivers)
+
+        # only model instances can be passed to tasks
+        with self.assertRaises(ImproperlyConfigured):
+            SampleI(self.object_item, [self.object_receiver], {}).send_distributed()
+
+        # tasks are not available without Celery app
+        with mock.patch.dict(sys.modules, {"universal_notifications.tasks": types.ModuleType("tasks")}):
+            with self.assertRaisesMessage(ImproperlyConfigured, "CELERY_APP_PATH"):
+                SampleI(item, User.objects.all(), {}).send_distributed()
+
+    def test_email_connection(self):
+        receivers = [SampleReceiver("foo{}@bar.com".format(i), "123456789") for i in range(5)]
+        connection = mail.get_connection()
+        with mock.patch("universal_notifications.notifications.get_connection",
+                        return_value=connection) as mocked_get_connection:
+            with mock.patch.object(connection, "send_messages", wraps=connection.send_messages) as mocked_send:
+                SampleF(self.object_item, receivers, {}).send()
+                mocked_get_connection.assert_called_once_with(fail_silently=False)
+                self.assertEqual([len(x[0][0]) for x in mocked_send.call_args_list], [1] * 5)
+        self.assertEqual(len(mail.outbox), 5)
+
+        # reconnect when server disconnected, messages sent before are not sent again
+        mail.outbox = []
+        connection = mail.get_connection()
+        with mock.patch("universal_notifications.notifications.get_connection", return_value=connection):
+            with mock.patch.object(connection, "send_messages",
+                                   side_effect=[1, SMTPServerDisconnected(), 1, 1]) as mocked_send:
+                with mock.patch.object(connection, "open") as mocked_open:
+                    SampleF(self.object_item, receivers[:3], {}).send()
+                    self.assertEqual(mocked_open.call_count, 2)
+                    sent_to = [x[0][0][0].to[0] for x in mocked_send.call_args_list]
+                    # only the message which failed is sent again
+                    self.assertEqual(sent_to[1], sent_to[2])
+                    self.assertEqual(sorted(set(sent_to)), [formataddr(("Foo Bar", "foo{}@bar.com".format(i)))
+                                                            for i in range(3)])
+
+        # no connection without receivers
+        with mock.patch("universal_notifications.notifications.get_connection") as mocked_get_connection:
+            SampleF(self.object_item, [], {}).send()
+            SampleF(self.object_item, [self.object_receiver], {}).send_inner(set(), {})
+            mocked_get_connection.assert_not_called()
+
+    @override_settings(UNIVERSAL_NOTIFICATIONS_PUSH_CHUNK_SIZE=2)
+    def test_push_devices_fetched_in_chunks(self):
+        users = [User.objects.create_user(username="push{}".format(i), email="push{}@foo.com".format(i))
+                 for i in range(3)]
+        devices = [Device.objects.create(user=user, platform=Device.PLATFORM_FCM) for user in users]
+        Device.objects.create(user=users[0], platform=Device.PLATFORM_FCM, is_active=False)
+
+        with mock.patch("universal_notifications.notifications.send_bulk_message") as mocked_send_message:
+            with CaptureQueriesContext(db_connection) as queries:
+                SampleG(self.object_item, users, {"item": self.object_item}).send()
+            self.assertEqual(mocked_send_message.call_count, 2)
+            sent_devices = [device for call in mocked_send_message.call_args_list for device in call[0][0]]
+            self.assertEqual(sorted(x.pk for x in sent_devices), [x.pk for x in devices])
+        self.assertEqual(len([x for x in queries if Device._meta.db_table in x["sql"]]), 2)
+
+    def test_ws_serialization(self):
+        class SampleChunkedD(SampleD):
+            receivers_chunk_size = 1
+
+        class SampleCachedD(SampleD):
+            cache_serialized_data = True
+
+            def get_item_version(self):
+                return self.item.name
+
+        cache.clear()
+        receivers = [self.object_receiver, self.regular_user]
+        with mock.patch("universal_notifications.notifications.publish_bulk") as mocked_publish, \
+                mock.patch("universal_notifications.notifications.get_message",
+                           wraps=get_message) as mocked_get_message:
+            SampleChunkedD(self.object_item, receivers, {}).send()
+            self.assertEqual(mocked_publish.call_count, 2)
+            # serialized & encoded once for all chunks
+            mocked_get_message.assert_called_once()
+            self.assertEqual(mocked_publish.call_args_list[0][1]["message"],
+                             mocked_publish.call_args_list[1][1]["message"])
+
+        with mock.patch("universal_notifications.notifications.publish_bulk"), \
+                mock.patch.object(SampleSerializer, "to_representation", autospec=True,
+                                  side_effect=lambda self, item: {"name": item.name}) as mocked_serialize:
+            SampleD(self.object_item, receivers, {}).send()
+            SampleD(self.object_item, receivers, {}).send()
+            self.assertEqual(mocked_serialize.call_count, 2)
+
+            mocked_serialize.reset_mock()
+            self.object_item.pk = 1
+            SampleCachedD(self.object_item, receivers, {}).send()
+            SampleCachedD(self.object_item, receivers, {}).send()
+            self.assertEqual(mocked_serialize.call_count, 1)
+
+            # new version of the item is serialized again
+            self.object_item.name = "changed"
+            notification = SampleCachedD(self.object_item, receivers, {})
+            self.assertEqual(notification.prepare_message()["data"], {"name": "changed"})
+            self.assertEqual(mocked_serialize.call_count, 2)
+
+            # unsaved items are not cached
+            self.assertIsNone(SampleCachedD(SampleModel(name="new"), receivers, {}).get_serialization_cache_key())
+            self.assertIsNone(SampleD(self.object_item, receivers, {}).get_serialization_cache_key())
+            # items without version are not cached
+            SampleD.cache_serialized_data = True
+            try:
+                self.assertIsNone(SampleD(self.object_item, receivers, {}).get_serialization_cache_key())
+            finally:
+                SampleD.cache_serialized_data = False
+
+    def test_email_prepared_once(self):
+        emails = ["foo{}@bar.com".format(i) for i in range(5)]
+        receivers = [SampleReceiver(email, "123456789") for email in emails]
+        with mock.patch("universal_notifications.notifications.get_template", wraps=get_template) as mocked_template:
+            with mock.patch("universal_notifications.notifications.Site.objects.get_current",
+                            wraps=Site.objects.get_current) as mocked_site:
+                with mock.patch("universal_notifications.notifications.get_static_cache_paths",
+                                wraps=get_static_cache_paths) as mocked_paths:
+                    SampleF(self.object_item, receivers, {}).send()
+                    self.assertEqual(mocked_template.call_count, 1)
+                    self.assertEqual(mocked_site.call_count, 1)
+                    self.assertEqual(mocked_paths.call_count, 1)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(sorted(x.to[0] for x in mail.outbox), ["Foo Bar <{}>".format(x) for x in emails])
+
+    def test_email_premailer_cache(self):
+        class SampleStyles(SampleF):
+            email_name = "test_styles"
+            cache_premailer = True
+
+        class SampleStylesWithExtends(SampleStyles):
+            email_name = "test_extends"
+
+        clear_inlined_templates_cache()
+        receivers = [SampleReceiver("foo@bar.com", "123456789", first_name="Foo"),
+                     SampleReceiver("bar@bar.com", "123456789", first_name="Bar")]
+        with mock.patch("universal_notifications.backends.emails.inline_css.Premailer",
+                        wraps=Premailer) as mocked_premailer:
+            SampleStyles(self.object_item, receivers, {}).send()
+            SampleStyles(self.object_item, receivers, {}).send()
+            self.assertEqual(mocked_premailer.call_count, 1)
+
+        self.assertEqual(len(mail.outbox), 4)
+        bodies = sorted(x.body for x in mail.outbox[:2])
+        self.assertIn('<p class="greeting" style="color:red">Hello Bar</p>', bodies[0])
+        self.assertIn('<p class="greeting" style="color:red">Hello Foo</p>', bodies[1])
+        self.assertIn('<a href="http://example.com/static/logo.png" title="sample">sample</a>', bodies[0])
+
+        # templates extending other templates are inlined for each email
+        with mock.patch("universal_notifications.backends.emails.inline_css.Premailer",
+                        wraps=Premailer) as mocked_premailer:
+            SampleStylesWithExtends(self.object_item, receivers, {}).send()
+            self.assertEqual(mocked_premailer.call_count, 2)
+        self.assertEqual(sorted(x.body for x in mail.outbox[4:]), bodies)
+
+        # as well as templates with template tags building attributes of elements
+        class SampleConditionalClass(SampleStyles):
+            email_name = "test_conditional_class"
+
+        mail.outbox = []
+        with mock.patch("universal_notifications.backends.emails.inline_css.Premailer",
+                        wraps=Premailer) as mocked_premailer:
+            SampleConditionalClass(self.object_item, receivers, {}).send()
+            self.assertEqual(mocked_premailer.call_count, 2)
+        bodies = sorted(x.body for x in mail.outbox)
+        self.assertIn('<p class="x" style="color:red">Hello Bar</p>', bodies[0])
+        self.assertIn('<p class="y" style="color:blue">Hello Foo</p>', bodies[1])
+
+        # and templates with structural selectors (matched against a single iteration of loops in the source)
+        class SampleStructural(SampleStyles):
+            email_name = "test_structural"
+
+        mail.outbox = []
+        with mock.patch("universal_notifications.backends.emails.inline_css.Premailer",
+                        wraps=Premailer) as mocked_premailer:
+            SampleStructural(self.object_item, receivers[:1], {}).send()
+            self.assertEqual(mocked_premailer.call_count, 1)
+        self.assertIn('<li style="color:red">a</li>\n<li>b</li>', mail.outbox[0].body)
+
+    def test_email_is_inlinable(self):
+        self.assertTrue(is_inlinable('<p class="x">{{ a }}</p>'
+                                     '<a href="{% url "home" %}" title=\'{{ b|default:"c" }}\'>'))
+        self.assertTrue(is_inlinable('{% if a %}<p class="x">{% else %}<p class="y">{% endif %}</p>'))
+        self.assertFalse(is_inlinable('<p {% if a %}class="y"{% else %}class="x"{% endif %}>a</p>'))
+        self.assertFalse(is_inlinable('<p class="{{ a }}">a</p>'))
+        self.assertFalse(is_inlinable("<p id='item-{{ a }}'>a</p>"))
+        self.assertFalse(is_inlinable('<style>p { color: {{ color }}; }</style><p>a</p>'))
+        self.assertFalse(is_inlinable('{% extends "base.html" %}'))
+        self.assertTrue(is_inlinable('<style>a[title~="x"] { color: red; } p { margin: 0 +1px; }</style><p>a</p>'))
+        for selector in ("li:first-child", "li:last-child", "tr:nth-child(2n)", "p:only-of-type", "td:empty",
+                         "p + p", "h1~p"):
+            self.assertFalse(is_inlinable("<style>%s { color: red; }</style><p>a</p>" % selector), selector)
+        self.assertFalse(is_inlinable("<style>@media print { p { margin: 0; } p.x + p { color: red; } }</style>"))
+
     def test_email_attachments(self):
         mail.outbox = []
         attachments = [
@@ -291,6 +664,28 @@ class BaseTest(APITestCase):
             })
         self.assertEqual(NotificationHistory.objects.count(), 1)
 
+    @override_settings(UNIVERSAL_NOTIFICATIONS_HISTORY_BATCH_SIZE=2)
+    def test_history_batches(self):
+        receivers = [SampleReceiver("foo{}@bar.com".format(i), "123456789") for i in range(5)]
+        with mock.patch("universal_notifications.history.NotificationHistory.objects.bulk_create",
+                        wraps=NotificationHistory.objects.bulk_create) as mocked_bulk_create:
+            SampleD(self.object_item, receivers, {}).send()
+            self.assertEqual(mocked_bulk_create.call_count, 3)
+        self.assertEqual(NotificationHistory.objects.count(), 5)
+        self.assertEqual(set(NotificationHistory.objects.values_list("receiver", flat=True)),
+                         {r.email for r in receivers})
+
+        # per-receiver fields can be customized
+        class SampleCustomHistory(SampleD):
+            def get_notification_history_data(self, receiver, base_data):
+                data = super(SampleCustomHistory, self).get_notification_history_data(receiver, base_data)
+                data["details"] = "custom: {}".format(receiver.email)
+                return data
+
+        NotificationHistory.objects.all().delete()
+        SampleCustomHistory(self.object_item, [self.object_receiver], {}).send()
+        self.assertEqual(NotificationHistory.objects.get().details, "custom: foo@bar.com")
+
     def test_getting_subject_from_html(self):
         # when subject is not provided in notification definition, the subject is taken from <title></title> tags
         notification = SampleF(self.object_item, [self.object_receiver], {})
@@ -0,0 +1,78 @@
+from unittest import mock
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
+from rest_framework.test import APITestCase
+from universal_notifications.backends.push.apns import APNSServerError
+from universal_notifications.backends.push.apns_http2 import APNSHTTP2Error
+from universal_notifications.backends.push.feedback import (get_feedback_stats, is_invalid_token, prune_devices,
+                                                            reset_feedback_stats)
+from universal_notifications.backends.push.gcm import gcm_send_message
+from universal_notifications.models import Device
+from universal_notifications.notifications import PushNotification
+
+
+class SamplePush(PushNotification):
+    title = "title"
+    category = "system"
+
+
+class FeedbackTests(APITestCase):
+    def setUp(self):
+        reset_feedback_stats()
+        self.user = User.objects.create_user(username="user", email="user@example.com", password="1234")
+
+    def create_devices(self, *platforms):
+        return [Device.objects.create(user=self.user, app_id="app1", platform=platform, notification_token=str(i))
+                for i, platform in enumerate(platforms)]
+
+    def test_is_invalid_token(self):
+        self.assertTrue(is_invalid_token(Device.PLATFORM_IOS, APNSServerError(8, 0)))
+        self.assertFalse(is_invalid_token(Device.PLATFORM_IOS, APNSServerError(7, 0)))
+        self.assertTrue(is_invalid_token(Device.PLATFORM_IOS, APNSHTTP2Error(410, "Unregistered")))
+        self.assertTrue(is_invalid_token(Device.PLATFORM_IOS, APNSHTTP2Error(400, "BadDeviceToken")))
+        self.assertFalse(is_invalid_token(Device.PLATFORM_IOS, APNSHTTP2Error(429, "TooManyRequests")))
+        self.assertFalse(is_invalid_token(Device.PLATFORM_IOS, APNSHTTP2Error(400, "DeviceTokenNotForTopic")))
+        self.assertFalse(is_invalid_token(Device.PLATFORM_IOS, None))
+        self.assertTrue(is_invalid_token(Device.PLATFORM_FCM, {"error": "NotRegistered"}))
+        self.assertTrue(is_invalid_token(Device.PLATFORM_GCM, {"error": "InvalidRegistration"}))
+        self.assertFalse(is_invalid_token(Device.PLATFORM_GCM, {"error": "Unavailable"}))
+        self.assertFalse(is_invalid_token(Device.PLATFORM_FCM, {"message_id": "1"}))
+        self.assertFalse(is_invalid_token(Device.PLATFORM_FCM, None))
+
+    def test_prune_devices(self):
+        devices = self.create_devices(Device.PLATFORM_IOS, Device.PLATFORM_FCM, Device.PLATFORM_FCM,
+                                      Device.PLATFORM_GCM)
+        results = [APNSServerError(8, 0), {"error": "NotRegistered"}, {"message_id": "1"}, {"error": "NotRegistered"}]
+        with self.assertNumQueries(1):
+            counts = prune_devices(devices, results)
+        self.assertEqual(counts, {Device.PLATFORM_IOS: 1, Device.PLATFORM_FCM: 1, Device.PLATFORM_GCM: 1})
+        self.assertEqual(list(Device.objects.filter(is_active=True)), [devices[2]])
+        self.assertEqual(get_feedback_stats(), counts)
+
+        # already deactivated devices are not counted again
+        self.assertEqual(prune_devices(devices, results), {})
+
+        with override_settings(UNIVERSAL_NOTIFICATIONS_PUSH_PRUNE_DEVICES=False):
+            self.assertEqual(prune_devices(devices[2:3], [{"error": "NotRegistered"}]), {})
+            self.assertTrue(Device.objects.get(pk=devices[2].pk).is_active)
+
+    def test_push_notification(self):
+        devices = self.create_devices(Device.PLATFORM_FCM, Device.PLATFORM_FCM)
+        with mock.patch("universal_notifications.notifications.send_bulk_message",
+                        return_value=[{"message_id": "1"}, {"error": "NotRegistered"}]):
+            result = SamplePush(None, [self.user], {}).send()
+        self.assertEqual(result, {"devices": 2, "deactivated": 1})
+        self.assertEqual(list(Device.objects.filter(is_active=True)), devices[:1])
+
+    @override_settings(UNIVERSAL_NOTIFICATIONS_MOBILE_APPS={"app1": {"GCM_API_KEY": "secret"}})
+    @mock.patch("universal_notifications.backends.push.gcm.urlopen")
+    def test_gcm_send_message(self, mocked_urlopen):
+        device = self.create_devices(Device.PLATFORM_GCM)[0]
+        mocked_urlopen.return_value.read.return_value = "Error=Unavailable"
+        self.assertFalse(gcm_send_message(device, "msg", {}))
+        self.assertTrue(Device.objects.get(pk=device.pk).is_active)
+
+        mocked_urlopen.return_value.read.return_value = "Error=NotRegistered"
+        self.assertFalse(gcm_send_message(device, "msg", {}))
+        self.assertFalse(Device.objects.get(pk=device.pk).is_active)
+        self.assertEqual(get_feedback_stats(), {Device.PLATFORM_GCM: 1})
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+
+from unittest import mock
+from django.test import TestCase
+from django.test.utils import override_settings
+from tests.test_base import SampleE, SampleModel, SampleReceiver
+from universal_notifications.history import (BufferedHistorySink, DatabaseHistorySink, FileHistorySink,
+                                             LogHistorySink, MultipleHistorySink, get_history_sink)
+from universal_notifications.models import NotificationHistory
+
+
+class HistoryTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.history_file = os.path.join(self.tmp_dir, "history.jsonl")
+        self.records = [
+            {"group": "Email", "klass": "Sample", "receiver": "foo{}@bar.com".format(i), "details": "test",
+             "category": "default"}
+            for i in range(3)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_default_sinks(self):
+        sink = get_history_sink()
+        self.assertIsInstance(sink, MultipleHistorySink)
+        self.assertEqual([type(x) for x in sink.sinks], [DatabaseHistorySink, LogHistorySink])
+
+        with override_settings(UNIVERSAL_NOTIFICATIONS_HISTORY_USE_DATABASE=False):
+            self.assertEqual([type(x) for x in get_history_sink().sinks], [LogHistorySink])
+
+        with override_settings(UNIVERSAL_NOTIFICATIONS_HISTORY_BUFFER_SIZE=10):
+            self.assertIsInstance(get_history_sink(), BufferedHistorySink)
+
+    def test_file_sink(self):
+        with override_settings(UNIVERSAL_NOTIFICATIONS_HISTORY_FILE=self.history_file):
+            sink = FileHistorySink()
+            sink.write(self.records[:2])
+            sink.write(self.records[2:])
+
+        with open(self.history_file) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([x["receiver"] for x in lines], ["foo0@bar.com", "foo1@bar.com", "foo2@bar.com"])
+        self.assertIn("created", lines[0])
+
+    def test_buffered_sink(self):
+        sink = BufferedHistorySink(DatabaseHistorySink(), buffer_size=3)
+        sink.write(self.records[:2])
+        self.assertEqual(NotificationHistory.objects.count(), 0)
+        sink.write(self.records[2:])
+        self.assertEqual(NotificationHistory.objects.count(), 3)
+
+        # flush on time threshold
+        sink = BufferedHistorySink(DatabaseHistorySink(), buffer_size=100, flush_interval=60)
+        with mock.patch("universal_notifications.history.time.monotonic", return_value=1000):
+            sink.write(self.records[:1])
+        self.assertEqual(NotificationHistory.objects.count(), 3)
+        with mock.patch("universal_notifications.history.time.monotonic", return_value=1060):
+            sink.write(self.records[1:2])
+        self.assertEqual(NotificationHistory.objects.count(), 5)
+
+        # explicit flush
+        sink.write(self.records[2:])
+        sink.flush()
+        self.assertEqual(NotificationHistory.objects.count(), 6)
+
+    def test_buffered_sink_timer(self):
+        with mock.patch("universal_notifications.history.threading.Timer") as timer_mock:
+            sink = BufferedHistorySink(DatabaseHistorySink(), buffer_size=100, flush_interval=60)
+            sink.write(self.records[:1])
+            sink.write(self.records[1:2])
+        # one timer per buffered batch
+        timer_mock.assert_called_once_with(60, sink._flush_on_timer)
+        timer_mock.return_value.start.assert_called_once_with()
+        self.assertEqual(NotificationHistory.objects.count(), 0)
+
+        with mock.patch("universal_notifications.history.connections"):
+            sink._flush_on_timer()
+        self.assertEqual(NotificationHistory.objects.count(), 2)
+        self.assertIsNone(sink._timer)
+
+    def test_flush_on_worker_shutdown(self):
+        from celery.signals import worker_process_shutdown
+
+        with override_settings(UNIVERSAL_NOTIFICATIONS_HISTORY_BUFFER_SIZE=100,
+                               UNIVERSAL_NOTIFICATIONS_HISTORY_FLUSH_INTERVAL=None):
+            get_history_sink().write(self.records)
+            self.assertEqual(NotificationHistory.objects.count(), 0)
+            worker_process_shutdown.send(sender=None, pid=1, exitcode=0)
+            self.assertEqual(NotificationHistory.objects.count(), 3)
+
+    def test_buffered_sink_in_task(self):
+        sink = BufferedHistorySink(mock.MagicMock(), buffer_size=2, use_task=True)
+        sink.write(self.records)
+        sink.sink.write.assert_not_called()
+        self.assertEqual(NotificationHistory.objects.count(), 3)
+
+    def test_sms_history(self):
+        receiver = SampleReceiver("foo@bar.com", "123456789")
+        paths = ["universal_notifications.history.FileHistorySink"]
+        with override_settings(UNIVERSAL_NOTIFICATIONS_HISTORY_FILE=self.history_file,
+                               UNIVERSAL_NOTIFICATIONS_HISTORY_SINKS=paths), \
+                mock.patch("universal_notifications.notifications.send_sms"):
+            SampleE(SampleModel(name="sample"), [receiver], {}).send()
+
+        with open(self.history_file) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([x["receiver"] for x in lines], [str(receiver)])
+        self.assertEqual(lines[0]["klass"], "SampleE")
+
+    def test_sms_history_in_task(self):
+        receiver = SampleReceiver("foo@bar.com", "123456789")
+        with override_settings(UNIVERSAL_NOTIFICATIONS_HISTORY_BUFFER_SIZE=1,
+                               UNIVERSAL_NOTIFICATIONS_HISTORY_IN_TASK=True), \
+                mock.patch("universal_notifications.notifications.send_sms"), \
+                mock.patch("universal_notifications.tasks.save_notification_history_task.delay") as task_mock:
+            SampleE(SampleModel(name="sample"), [receiver], {}).send()
+
+        # records passed to the task can be serialized with the json serializer
+        records = task_mock.call_args[0][0]
+        self.assertEqual(json.loads(json.dumps(records))[0]["receiver"], str(receiver))
@@ -0,0 +1,77 @@
+import uuid
+from unittest import mock
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+from redis import StrictRedis
+from redis.backoff import NoBackoff
+from redis.exceptions import ConnectionError
+from redis.retry import Retry
+from ws4redis import settings as private_settings
+from universal_notifications.backends.sms.rate_limit import (MemoryRateLimiter, RedisRateLimiter, get_rate_limiter,
+                                                             wait_for_token)
+
+
+class RateLimitTests(SimpleTestCase):
+
+    @mock.patch("universal_notifications.backends.sms.rate_limit.time")
+    def test_memory_limiter(self, time_mock):
+        limiter = MemoryRateLimiter()
+        time_mock.monotonic.return_value = 100.0
+        # burst of 2 tokens, then 1 token per 10 seconds
+        self.assertEqual(limiter.acquire("a", 0.1, 2), 0)
+        self.assertEqual(limiter.acquire("a", 0.1, 2), 0)
+        self.assertAlmostEqual(limiter.acquire("a", 0.1, 2), 10)
+        self.assertEqual(limiter.acquire("b", 0.1, 2), 0)  # buckets are per key
+
+        time_mock.monotonic.return_value = 105.0
+        self.assertAlmostEqual(limiter.acquire("a", 0.1, 2), 5)
+        time_mock.monotonic.return_value = 110.0
+        self.assertEqual(limiter.acquire("a", 0.1, 2), 0)
+
+        # idle bucket is refilled up to its capacity
+        time_mock.monotonic.return_value = 1000.0
+        self.assertEqual(limiter.acquire("a", 0.1, 2), 0)
+        self.assertEqual(limiter.acquire("a", 0.1, 2), 0)
+        self.assertAlmostEqual(limiter.acquire("a", 0.1, 2), 10)
+
+    @override_settings(UNIVERSAL_NOTIFICATIONS_RATE_LIMIT_BACKEND="memory", UNIVERSAL_NOTIFICATIONS_RATE_LIMIT_BURST=1)
+    def test_wait_for_token(self):
+        limiter = get_rate_limiter()
+        self.assertIsInstance(limiter, MemoryRateLimiter)
+        self.assertIs(get_rate_limiter(), limiter)
+
+        with mock.patch.object(limiter, "acquire", side_effect=[2.5, 0]) as acquire_mock, \
+                mock.patch("universal_notifications.backends.sms.rate_limit.time.sleep") as sleep_mock:
+            wait_for_token("+18023390050", 6)
+        self.assertEqual(acquire_mock.call_args_list, [mock.call("__un_rate:+18023390050", 0.1, 1)] * 2)
+        sleep_mock.assert_called_once_with(2.5)
+
+    @mock.patch("universal_notifications.backends.sms.rate_limit.StrictRedis")
+    def test_redis_limiter(self, redis_mock):
+        script = redis_mock.return_value.register_script.return_value
+        script.return_value = b"2.5"
+        limiter = RedisRateLimiter()
+        self.assertEqual(limiter.acquire("a", 0.1, 2), 2.5)
+        script.assert_called_once_with(keys=["a"], args=[0.1, 2])
+
+        with override_settings(UNIVERSAL_NOTIFICATIONS_RATE_LIMIT_BACKEND="redis"):
+            self.assertIsInstance(get_rate_limiter(), RedisRateLimiter)
+
+    def test_redis_limiter_script(self):
+        """Runs the token bucket script on the Redis server (skipped if it is not available)."""
+        connection = StrictRedis(retry=Retry(NoBackoff(), 0), **private_settings.WS4REDIS_CONNECTION)
+        try:
+            connection.ping()
+        except ConnectionError:
+            self.skipTest("Redis server is not available")
+
+        key = "__un_rate_test:{}".format(uuid.uuid4().hex)
+        self.addCleanup(connection.delete, key)
+        limiter = RedisRateLimiter()
+        # burst of 2 tokens, then 1 token per 10 seconds
+        self.assertEqual(limiter.acquire(key, 0.1, 2), 0)
+        self.assertEqual(limiter.acquire(key, 0.1, 2), 0)
+        self.assertAlmostEqual(limiter.acquire(key, 0.1, 2), 10, delta=0.5)
+        self.assertEqual(limiter.acquire("{}:b".format(key), 0.1, 2), 0)  # buckets are per key
+        connection.delete("{}:b".format(key))
+        self.assertGreater(connection.pttl(key), 0)
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
+from datetime import timedelta
 from unittest import mock
 from django.core import mail
 from django.core.management import call_command
 from django.test.utils import override_settings
+from django.utils import timezone
 from tests.test_utils import APIBaseTestCase
 from universal_notifications.backends.sms.engines.twilio import Engine as SMS  # NOQA
-from universal_notifications.backends.sms.utils import send_sms
+from universal_notifications.backends.sms.utils import send_sms, send_sms_bulk
+from universal_notifications.management.commands.run_twilio_proxy import Command as ProxyCommand
+from universal_notifications.management.commands.run_twilio_proxy import Queue
 from universal_notifications.models import (Phone, PhonePendingMessages, PhoneReceived, PhoneReceivedRaw, PhoneReceiver,
                                             PhoneSent)
 
@@ -67,6 +71,120 @@ class ProxyTests(TwilioTestsCase):
             send_sms("+18023390051", "foo", priority=1)
             new_message(2, 1)
 
+    def test_send_bulk(self):
+        PhoneReceiver.objects.create(number="+18023390061", service_number="+18023390050")
+        PhoneReceiver.objects.create(number="+18023390062", service_number="+18023390050", is_blocked=True)
+        numbers = ["+18023390061", "+18023390062", "+18023390063", "802-339-0063", "+18023390064", "invalid"]
+
+        with mock.patch("universal_notifications.backends.sms.engines.twilio.StrictRedis") as redis_mock:
+            # existing receivers, new receivers, service numbers, messages & pending messages fetched/created in bulk
+            with self.assertNumQueries(7):
+                send_sms_bulk(numbers, u"foo😄", priority=1, send_async=False)
+            # dispatcher notified once per service number
+            self.assertEqual(redis_mock.return_value.publish.call_count, 1)
+
+        self.assertEqual(PhoneReceiver.objects.count(), 4)
+        self.assertEqual(PhoneReceiver.objects.get(number="+18023390064").service_number, "+18023390050")
+        messages = PhoneSent.objects.order_by("receiver__number")
+        self.assertEqual([(x.receiver.number, x.status, x.text) for x in messages], [
+            ("+18023390061", PhoneSent.STATUS_QUEUED, "foo"),
+            ("+18023390062", PhoneSent.STATUS_FAILED, "foo"),
+            ("+18023390063", PhoneSent.STATUS_QUEUED, "foo"),
+            ("+18023390064", PhoneSent.STATUS_QUEUED, "foo"),
+        ])
+        pending = PhonePendingMessages.objects.order_by("message__receiver__number")
+        self.assertEqual([(x.message.receiver.number, x.from_phone, x.priority) for x in pending], [
+            ("+18023390061", "+18023390050", 1),
+            ("+18023390063", "+18023390050", 1),
+            ("+18023390064", "+18023390050", 1),
+        ])
+
+    @override_settings(UNIVERSAL_NOTIFICATIONS_TWILIO_PROXY_BATCH_SIZE=2)
+    def test_proxy_queue(self):
+        with mock.patch("universal_notifications.backends.sms.engines.twilio.StrictRedis"):
+            send_sms_bulk(["+18023390061"], "low", priority=100, send_async=False)
+            send_sms_bulk(["+18023390062"], "high", priority=1, send_async=False)
+            send_sms_bulk(["+18023390063"], "medium", priority=10, send_async=False)
+
+        command = ProxyCommand()
+        queue = Queue(command, self.phone)
+        command.queues[self.phone.number] = queue
+        sent = []
+        with mock.patch("universal_notifications.management.commands.run_twilio_proxy.wait_for_token") as wait_mock, \
+                mock.patch.object(PhoneSent, "send", autospec=True, side_effect=lambda x: sent.append(x.text)):
+            # 2 batches claimed in transactions (select, lock & fetch), 1 empty batch, no count queries,
+            # claim extended, message saved & deleted per message
+            with self.assertNumQueries(2 * 5 + 3 + 3 * 3):
+                queue.check_messages()
+
+        # rate limited per service number
+        self.assertEqual(wait_mock.call_args_list, [mock.call(self.phone.number, self.phone.rate)] * 3)
+        self.assertEqual(sent, ["high", "medium", "low"])
+        self.assertFalse(PhonePendingMessages.objects.exists())
+        self.assertEqual(command.queues, {})
+
+        # queues notified about new messages are not stopped
+        queue.notify()
+        self.assertFalse(queue.stop())
+        with mock.patch.object(Queue, "start") as start_mock:
+            command.dispatch(self.phone.number)
+            command.dispatch("+18023390099")  # unknown number
+        self.assertEqual(start_mock.call_count, 1)
+        self.assertEqual(list(command.queues), [self.phone.number])
+        with mock.patch.object(Queue, "start") as start_mock:
+            command.dispatch(self.phone.number)
+        self.assertEqual(start_mock.call_count, 0)
+        self.assertTrue(command.queues[self.phone.number].wakeup.is_set())
+
+    @override_settings(UNIVERSAL_NOTIFICATIONS_TWILIO_PROXY_BATCH_SIZE=3)
+    def test_proxy_queue_claim_expired(self):
+        with mock.patch("universal_notifications.backends.sms.engines.twilio.StrictRedis"):
+            send_sms_bulk(["+18023390061"], "first", priority=1, send_async=False)
+            send_sms_bulk(["+18023390062"], "second", priority=2, send_async=False)
+            send_sms_bulk(["+18023390063"], "third", priority=3, send_async=False)
+
+        command = ProxyCommand()
+        queue = Queue(command, self.phone)
+        command.queues[self.phone.number] = queue
+        sent = []
+        other_claims = []
+
+        def wait_for_token(number, rate):
+            if len(sent) == 1 and not other_claims:
+                # claim of the batch expires while waiting for the rate limit, another consumer claims the rest
+                PhonePendingMessages.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+                other_claims.extend(PhonePendingMessages.objects.claim(self.phone.number, 3))
+
+        with mock.patch("universal_notifications.management.commands.run_twilio_proxy.wait_for_token",
+                        side_effect=wait_for_token), \
+                mock.patch.object(PhoneSent, "send", autospec=True, side_effect=lambda x: sent.append(x.text)):
+            queue.check_messages()
+
+        # messages claimed by the other consumer are not sent again nor deleted
+        self.assertEqual(sent, ["first"])
+        self.assertEqual([x.message.text for x in other_claims], ["second", "third"])
+        self.assertEqual(PhonePendingMessages.objects.count(), 2)
+
+    def test_claim_messages(self):
+        with mock.patch("universal_notifications.backends.sms.engines.twilio.StrictRedis"):
+            send_sms_bulk(["+18023390061", "+18023390062"], "low", priority=100, send_async=False)
+            send_sms_bulk(["+18023390063"], "high", priority=1, send_async=False)
+            PhonePendingMessages.objects.create(from_phone="802-339-0057")
+
+        claimed = PhonePendingMessages.objects.claim(self.phone.number, 2)
+        self.assertEqual([x.message.text for x in claimed], ["high", "low"])
+        self.assertEqual(claimed[0].message.receiver.number, "+18023390063")
+
+        # claimed messages are not visible to other consumers
+        claimed = PhonePendingMessages.objects.claim(self.phone.number, 2)
+        self.assertEqual([x.message.receiver.number for x in claimed], ["+18023390062"])
+        self.assertEqual(PhonePendingMessages.objects.claim(self.phone.number, 2), [])
+
+        # until visibility timeout passes (consumer crashed)
+        with override_settings(UNIVERSAL_NOTIFICATIONS_TWILIO_PROXY_VISIBILITY_TIMEOUT=0):
+            self.assertEqual(len(PhonePendingMessages.objects.claim("+18023390057", 2)), 1)
+            self.assertEqual(len(PhonePendingMessages.objects.claim("+18023390057", 2)), 1)
+
     def test_check_queue(self):
         with mock.patch("universal_notifications.backends.sms.engines.twilio.StrictRedis"):
             PhonePendingMessages.objects.create(from_phone="802-339-0057")
@@ -79,6 +197,30 @@ class ProxyTests(TwilioTestsCase):
             self.assertEqual(redis_mock.call_count, 2)
 
 
+class ServiceNumbersTests(TwilioTestsCase):
+
+    def test_get_service_numbers(self):
+        sms = SMS()
+        self.assertEqual(sms.get_service_number(), "")
+
+        Phone.objects.create(number="+18023390050", rate=2)
+        Phone.objects.create(number="+18023390051", rate=1, used_count=1)
+        # numbers loaded once, used_count of all allocated numbers incremented with one query
+        with self.assertNumQueries(2):
+            numbers = sms.get_service_numbers(5)
+        self.assertEqual(numbers.count("+18023390050"), 4)
+        self.assertEqual(numbers.count("+18023390051"), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(sms.get_service_number(), "+18023390050")
+        self.assertEqual(dict(Phone.objects.values_list("number", "used_count")),
+                         {"+18023390050": 5, "+18023390051": 2})
+
+        # counts of other workers are taken into account after reload
+        Phone.objects.filter(number="+18023390051").update(used_count=100)
+        with override_settings(UNIVERSAL_NOTIFICATIONS_TWILIO_SERVICE_NUMBERS_CACHE_TIMEOUT=0):
+            self.assertEqual(sms.get_service_numbers(3), ["+18023390050"] * 3)
+
+
 class ReceivedTests(TwilioTestsCase):
 
     @override_settings(ADMINS=(("Admin", "foo@bar.com"),))
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Inlining CSS styles in emails with Premailer
+
+inline_css() transforms rendered html (for every email), get_inlined_template() transforms the template source once
+(per template file modification time & base url) and returns a template which can be rendered without Premailer.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+from urllib.parse import urljoin
+
+from django.conf import settings
+from premailer import Premailer
+
+TEMPLATE_TAG_RE = re.compile(r"{%.*?%}|{{.*?}}|{#.*?#}", re.DOTALL)
+# templates which styles cannot be inlined from the template source
+NOT_INLINABLE_RE = re.compile(r"{%\s*(extends|include|compress)\b")
+PLACEHOLDER = "untemplatetag{}x"
+PLACEHOLDER_RE = re.compile(r"untemplatetag\d*x")
+ELEMENT_RE = re.compile(r"<[^<>]*>")
+STYLE_RE = re.compile(r"<style\b[^>]*>(.*?)</style>", re.DOTALL | re.IGNORECASE)
+QUOTED_RE = re.compile(r"\"[^\"]*\"|'[^']*'")
+SELECTOR_ATTRIBUTE_RE = re.compile(r"""\s(?:class|id)\s*=\s*("[^"]*"|'[^']*')""", re.IGNORECASE)
+URL_ATTRIBUTE_RE = re.compile(r"""(\s(?:href|src)\s*=\s*)("[^"]*"|'[^']*')""", re.IGNORECASE)
+# parts of stylesheets which are not selectors (declarations - innermost blocks, comments, attribute selectors
+# & strings)
+CSS_NOT_SELECTOR_RE = re.compile(r"{[^{}]*}|/\*.*?\*/|\[[^\]]*\]|\"[^\"]*\"|'[^']*'", re.DOTALL)
+# selectors depending on siblings of an element - in the template source loops have a single iteration
+STRUCTURAL_SELECTOR_RE = re.compile(r":(?:first-child|last-child|first-of-type|last-of-type|nth-|only-|empty\b)|[+~]",
+                                    re.IGNORECASE)
+
+_inlined_templates = {}  # {(template path, base url): (modification time, template)}
+_lock = threading.Lock()
+
+
+def get_premailer(html, base_url, **kwargs):
+    return Premailer(html,
+                     remove_classes=False,
+                     exclude_pseudoclasses=False,
+                     keep_style_tags=True,
+                     include_star_selectors=True,
+                     strip_important=False,
+                     cssutils_logging_level=logging.CRITICAL,
+                     base_url=base_url,
+                     **kwargs)
+
+
+def get_static_cache_paths():
+    """Returns (url, local path) of compressed static files - Premailer reads them from disk."""
+    return ("{settings.STATIC_URL}CACHE/".format(settings=settings),
+            "{settings.STATIC_ROOT}/CACHE/".format(settings=settings))
+
+
+def inline_css(html, base_url, static_cache_paths=None):
+    html = html.replace(*(static_cache_paths or get_static_cache_paths()))  # get local file
+    return get_premailer(html, base_url).transform()
+
+
+def is_inlinable(source):
+    """Checks if styles of the template can be inlined from its source.
+
+    Templates extending or including other templates, template tags building attributes of html elements
+    (or values of class & id attributes), template tags in <style> and structural or sibling selectors
+    (i.e. li:first-child, p + p - matched against a single iteration of loops) change which CSS rules apply
+    to an element, such templates are inlined for each email.
+    """
+    if NOT_INLINABLE_RE.search(source):
+        return False
+
+    marker = PLACEHOLDER.format("")
+    html = TEMPLATE_TAG_RE.sub(marker, source)
+    for match in STYLE_RE.finditer(html):
+        stylesheet = match.group(1)
+        if marker in stylesheet:
+            return False
+        if STRUCTURAL_SELECTOR_RE.search(CSS_NOT_SELECTOR_RE.sub(" ", stylesheet)):
+            return False
+    for match in ELEMENT_RE.finditer(html):
+        element = match.group(0)
+        if marker in QUOTED_RE.sub("", element):
+            return False
+        if any(marker in value for value in SELECTOR_ATTRIBUTE_RE.findall(element)):
+            return False
+    return True
+
+
+def inline_css_in_template_source(source, base_url):
+    """Inlines CSS in a template source - template tags are replaced with placeholders for Premailer.
+
+    Links are made absolute like Premailer does for rendered emails, except links built with template tags
+    (which are kept as rendered, so they should be absolute already).
+    """
+    tags = []
+
+    def hide_tag(match):
+        tags.append(match.group(0))
+        return PLACEHOLDER.format(len(tags) - 1)
+
+    # anything before the document (i.e. {% load %} tags) is not passed to Premailer
+    start = source.find("<")
+    prefix, html = (source[:start], source[start:]) if start > 0 else ("", source)
+    html = TEMPLATE_TAG_RE.sub(hide_tag, html)
+    html = get_premailer(html, base_url, disable_link_rewrites=True).transform()
+    html = make_links_absolute(html, base_url)
+    for i, tag in enumerate(tags):
+        html = html.replace(PLACEHOLDER.format(i), tag)
+    return prefix + html
+
+
+def make_links_absolute(html, base_url):
+    """Joins href & src attributes without template tags with base url (see Premailer link rewrites)."""
+    if not base_url:
+        return html
+
+    def replace_link(match):
+        quote, url = match.group(2)[0], match.group(2)[1:-1]
+        if PLACEHOLDER_RE.search(url) or url.startswith(("tel:", "cid:")):
+            return match.group(0)
+        return "{}{}{}{}".format(match.group(1), quote, urljoin(base_url, url), quote)
+
+    return ELEMENT_RE.sub(lambda match: URL_ATTRIBUTE_RE.sub(replace_link, match.group(0)), html)
+
+
+def get_inlined_template(template, base_url):
+    """Returns template with CSS inlined in its source, or None if it cannot be inlined (see is_inlinable).
+
+    Results are cached in memory and, if UNIVERSAL_NOTIFICATIONS_PREMAILER_CACHE_DIR is set, on disk.
+    Cache is invalidated when the template file is modified.
+    """
+    path = template.origin.name
+    try:
+        mtime = os.path.getmtime(path)
+    except (OSError, TypeError):
+        mtime = None
+
+    key = (path, base_url)
+    cached = _inlined_templates.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    source = template.template.source
+    if not is_inlinable(source):
+        inlined_template = None
+    else:
+        inlined_template = template.backend.from_string(get_inlined_source(source, path, mtime, base_url))
+
+    with _lock:
+        _inlined_templates[key] = (mtime, inlined_template)
+    return inlined_template
+
+
+def get_inlined_source(source, path, mtime, base_url):
+    cache_dir = getattr(settings, "UNIVERSAL_NOTIFICATIONS_PREMAILER_CACHE_DIR", None)
+    if not cache_dir:
+        return inline_css_in_template_source(source, base_url)
+
+    cache_key = hashlib.sha1("{}:{}:{}".format(path, mtime, base_url).encode("utf-8")).hexdigest()
+    cache_path = os.path.join(cache_dir, "{}.html".format(cache_key))
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding="utf-8") as f:
+            return f.read()
+
+    inlined_source = inline_css_in_template_source(source, base_url)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(cache_path, threading.get_ident())
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(inlined_source)
+    os.replace(tmp_path, cache_path)
+    return inlined_source
+
+
+def clear_inlined_templates_cache():
+    with _lock:
+        _inlined_templates.clear()
@@ -5,18 +5,24 @@ https://developer.apple.com/library/ios/documentation/NetworkingInternet/Concept
 """
 
 import json
+import select
 import socket
 import ssl
 import struct
+import threading
 import time
 from binascii import unhexlify
-from contextlib import closing
 
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
 from push_notifications import NotificationError
 from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 
-from universal_notifications.backends.push.utils import get_app_settings
+from universal_notifications.backends.push.utils import (PushTimeout, get_app_settings, get_deadline,
+                                                         get_remaining_time)
+
+APNS_SHUTDOWN = 10  # status of an error response sent when APNS closes the connection for maintenance
 
 
 class APNSError(NotificationError):
@@ -34,6 +40,9 @@ class APNSDataOverflow(APNSError):
     pass
 
 
+_validated_certificates = set()  # certificate files are read (to check they are readable) only once
+
+
 def _apns_create_socket(address_tuple, app_id):
     app_settings = get_app_settings(app_id)
     if not app_settings:
@@ -47,11 +56,13 @@ def _apns_create_socket(address_tuple, app_id):
             'to send messages through APNS.'
         )
 
-    try:
-        with open(certfile, "r") as f:
-            f.read()
-    except Exception as e:
-        raise ImproperlyConfigured("The APNS certificate file at %r is not readable: %s" % (certfile, e))
+    if certfile not in _validated_certificates:
+        try:
+            with open(certfile, "r") as f:
+                f.read()
+        except Exception as e:
+            raise ImproperlyConfigured("The APNS certificate file at %r is not readable: %s" % (certfile, e))
+        _validated_certificates.add(certfile)
 
     sock = socket.socket()
     sock = ssl.wrap_socket(sock, ssl_version=ssl.PROTOCOL_TLSv1, certfile=certfile)
@@ -60,6 +71,11 @@ def _apns_create_socket(address_tuple, app_id):
     return sock
 
 
+def _apns_use_http2(app_id):
+    """HTTP/2 API with token-based authentication is used if APNS_AUTH_KEY is set for the app."""
+    return bool((get_app_settings(app_id) or {}).get("APNS_AUTH_KEY"))
+
+
 def _apns_create_socket_to_push(app_id):
     return _apns_create_socket((SETTINGS["APNS_HOST"], SETTINGS["APNS_PORT"]), app_id)
 
@@ -81,34 +97,8 @@ def _apns_pack_frame(token_hex, payload, identifier, expiration, priority):
     return frame
 
 
-def _apns_check_errors(sock):
-    timeout = SETTINGS["APNS_ERROR_TIMEOUT"]
-    if timeout is None:
-        return  # assume everything went fine!
-    saved_timeout = sock.gettimeout()
-    try:
-        sock.settimeout(timeout)
-        data = sock.recv(6)
-        if data:
-            command, status, identifier = struct.unpack("!BBI", data)
-            # apple protocol says command is always 8. See http://goo.gl/ENUjXg
-            assert command == 8, "Command must be 8!"
-            if status != 0:
-                raise APNSServerError(status, identifier)
-    except socket.timeout:  # py3, see http://bugs.python.org/issue10272
-        pass
-    except ssl.SSLError as e:  # py2
-        if "timed out" not in e.message:
-            raise
-    except AttributeError:
-        pass
-    finally:
-        sock.settimeout(saved_timeout)
-
-
-def _apns_send(app_id, token, alert, badge=None, sound=None, category=None, content_available=False,
-               action_loc_key=None, loc_key=None, loc_args=[], extra={}, identifier=0,
-               expiration=None, priority=10, socket=None):
+def _apns_prepare_payload(alert, badge=None, sound=None, category=None, content_available=False,
+                          action_loc_key=None, loc_key=None, loc_args=[], extra={}):
     data = {}
     aps_data = {}
 
@@ -146,37 +136,236 @@ def _apns_send(app_id, token, alert, badge=None, sound=None, category=None, cont
     if len(json_data) > max_size:
         raise APNSDataOverflow("Notification body cannot exceed %i bytes" % (max_size))
 
+    return json_data
+
+
+def _apns_get_expiration_time(expiration):
     # if expiration isn't specified use 1 month from now
-    expiration_time = expiration if expiration is not None else int(time.time()) + 2592000
+    return expiration if expiration is not None else int(time.time()) + 2592000
 
-    frame = _apns_pack_frame(token, json_data, identifier, expiration_time, priority)
 
-    if socket:
-        socket.write(frame)
-    else:
-        with closing(_apns_create_socket_to_push(app_id)) as socket:
-            socket.write(frame)
-            _apns_check_errors(socket)
+class APNSConnection(object):
+    """Long-lived connection to APNS (see APNSConnectionPool)."""
 
+    def __init__(self, app_id):
+        self.app_id = app_id
+        self.socket = _apns_create_socket_to_push(app_id)
+        self.last_used = time.monotonic()
 
-def apns_send_message(device, message=None, description=None, data=None):
+    def write(self, data):
+        self.socket.sendall(data)
+        self.last_used = time.monotonic()
+
+    def read_error(self, timeout=0):
+        """Returns (status, identifier) of an error response or None if APNS did not respond within timeout.
+
+        APNS responds only to a failed notification, drops all notifications sent after it & closes the connection.
+        """
+        readable, _, _ = select.select([self.socket], [], [], timeout)
+        if not readable:
+            return None
+        data = self.socket.recv(6)
+        if len(data) < 6:
+            return APNS_SHUTDOWN, None  # connection closed without an error response
+        command, status, identifier = struct.unpack("!BBI", data)
+        # apple protocol says command is always 8. See http://goo.gl/ENUjXg
+        assert command == 8, "Command must be 8!"
+        return status, identifier
+
+    def close(self):
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+
+class APNSConnectionPool(object):
+    """Keeps APNS connections open between sends (per app_id) - TLS handshake is done once per connection.
+
+    Connections idle for longer than UNIVERSAL_NOTIFICATIONS_APNS_CONNECTION_IDLE_TIMEOUT seconds are reopened
+    and at most UNIVERSAL_NOTIFICATIONS_APNS_POOL_SIZE idle connections are kept per app_id.
     """
-    Sends an APNS notification to a single registration_id.
-    This will send the notification as form data.
 
-    Note that if set message should always be a string. If it is not set,
-    it won't be included in the notification. You will need to pass None
-    to this for silent notifications.
+    def __init__(self):
+        self._connections = {}  # {app_id: [idle connections]}
+        self._lock = threading.Lock()
+
+    def get(self, app_id):
+        idle_timeout = getattr(settings, "UNIVERSAL_NOTIFICATIONS_APNS_CONNECTION_IDLE_TIMEOUT", 300)
+        while True:
+            with self._lock:
+                connections = self._connections.get(app_id)
+                connection = connections.pop() if connections else None
+            if connection is None:
+                return APNSConnection(app_id)
+            if time.monotonic() - connection.last_used < idle_timeout and connection.read_error() is None:
+                return connection
+            connection.close()
+
+    def release(self, connection):
+        with self._lock:
+            connections = self._connections.setdefault(connection.app_id, [])
+            if len(connections) < getattr(settings, "UNIVERSAL_NOTIFICATIONS_APNS_POOL_SIZE", 2):
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for app_connections in connections.values():
+            for connection in app_connections:
+                connection.close()
+
+
+connection_pool = APNSConnectionPool()
+
+
+def _apns_send_frames(app_id, frames, deadline=None):
+    """Writes frames (identifier = index) through pooled connections in batches of
+    UNIVERSAL_NOTIFICATIONS_APNS_BATCH_SIZE, without waiting for a response after each frame.
+
+    When APNS responds with an error, the connection is reopened and frames after the failed one are sent again.
+    Frames not written before the deadline (see utils.get_deadline) are not sent.
+    If the connection fails without an error response, frames not confirmed by APNS are not sent again.
+    Returns {identifier: APNSError or PushTimeout} of failed frames.
+    """
+    batch_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_APNS_BATCH_SIZE", 500)
+    timeout = SETTINGS["APNS_ERROR_TIMEOUT"]
+    errors = {}
+    start = 0
+    while start < len(frames):
+        try:
+            connection = connection_pool.get(app_id)
+        except OSError as e:
+            errors.update((i, APNSError(e)) for i in range(start, len(frames)))
+            break
+
+        error = None
+        timed_out = None
+        try:
+            for batch_start in range(start, len(frames), batch_size):
+                if deadline is not None:
+                    remaining = get_remaining_time(deadline)
+                    if not remaining:
+                        timed_out = batch_start
+                        break
+                    connection.socket.settimeout(remaining)
+                connection.write(b"".join(frames[batch_start:batch_start + batch_size]))
+                error = connection.read_error()
+                if error:
+                    break
+            if error is None and timeout is not None:
+                error = connection.read_error(get_remaining_time(deadline, timeout))
+        except OSError as e:
+            # APNS closes the connection after an error response - it still may be read
+            try:
+                error = connection.read_error(get_remaining_time(deadline, timeout or 0))
+            except OSError:
+                error = None
+            if error is None:
+                connection.close()
+                if deadline is not None and isinstance(e, socket.timeout):
+                    failure = PushTimeout("Not sent before the timeout")
+                else:
+                    failure = APNSError(e)
+                errors.update((i, failure) for i in range(start, len(frames)))
+                break
+
+        if error is None:
+            connection.socket.settimeout(None)
+            connection_pool.release(connection)
+            if timed_out is not None:
+                errors.update((i, PushTimeout("Not sent before the timeout")) for i in range(timed_out, len(frames)))
+            break
+
+        connection.close()
+        status, identifier = error
+        if identifier is None or identifier < start:
+            failure = APNSError("APNS connection closed unexpectedly")
+            errors.update((i, failure) for i in range(start, len(frames)))
+            break
+        if status != APNS_SHUTDOWN:
+            errors[identifier] = APNSServerError(status, identifier)
+        # notifications after the failed one (or the last one sent before shutdown) have been dropped
+        start = identifier + 1
+    return errors
+
+
+def apns_send_bulk_message(devices, message=None, description=None, data=None, timeout=None):
     """
+    Sends an APNS notification to many devices using pooled connections
+    (or HTTP/2 API for apps with APNS_AUTH_KEY set, see apns_http2.py).
+
+    Returns list of errors (APNSError or None if notification has been accepted) for each device.
+    If timeout (seconds) is given, writes & requests are limited to the time left and PushTimeout
+    is returned for devices which have not been sent to in time.
+    """
+    deadline = get_deadline(timeout)
     alert = {
         "title": message,
         "body": description
     }
-    # do not send title if description is not provided (notification must contain the body param)
     if not description:
         alert = {
             "body": message
         }
 
-    data = data or {}
-    _apns_send(device.app_id, device.notification_token, alert, **data)
+    data = dict(data or {})
+    # identifiers are used to find failed devices, connections are taken from the pool
+    data.pop("identifier", None)
+    data.pop("socket", None)
+    expiration = _apns_get_expiration_time(data.pop("expiration", None))
+    push_type = "background" if data.get("content_available") and not message else "alert"
+    # APNS requires priority 5 for background notifications
+    priority = data.pop("priority", 5 if push_type == "background" else 10)
+    json_data = _apns_prepare_payload(alert, **data)
+
+    devices = list(devices)
+    results = [None] * len(devices)
+    devices_by_app = {}
+    for index, device in enumerate(devices):
+        devices_by_app.setdefault(device.app_id, []).append(index)
+
+    http2_indexes = []
+    for app_id, indexes in devices_by_app.items():
+        if _apns_use_http2(app_id):
+            http2_indexes.extend(indexes)
+            continue
+
+        frames = [_apns_pack_frame(devices[i].notification_token, json_data, identifier, expiration, priority)
+                  for identifier, i in enumerate(indexes)]
+        for identifier, error in _apns_send_frames(app_id, frames, deadline).items():
+            results[indexes[identifier]] = error
+
+    if http2_indexes:
+        from universal_notifications.backends.push.apns_http2 import apns_http2_send
+
+        errors = apns_http2_send([devices[i] for i in http2_indexes], json_data, expiration, priority, push_type,
+                                 timeout=get_remaining_time(deadline))
+        for index, error in zip(http2_indexes, errors):
+            results[index] = error
+    return results
+
+
+def close_connections(**kwargs):
+    if kwargs.get("setting", "UNIVERSAL_NOTIFICATIONS_MOBILE_APPS") == "UNIVERSAL_NOTIFICATIONS_MOBILE_APPS":
+        connection_pool.close()
+        _validated_certificates.clear()
+
+
+setting_changed.connect(close_connections)
+
+
+def apns_send_message(device, message=None, description=None, data=None):
+    """
+    Sends an APNS notification to a single registration_id (through pooled connections, see apns_send_bulk_message).
+
+    Note that if set message should always be a string. If it is not set,
+    it won't be included in the notification. You will need to pass None
+    to this for silent notifications.
+    Raises APNSError if the notification has not been accepted.
+    """
+    error = apns_send_bulk_message([device], message, description, data)[0]
+    if error:
+        raise error
@@ -0,0 +1,169 @@
+"""
+Apple Push Notification Service - HTTP/2 provider API with token-based authentication
+Documentation is available on the Apple Developer site:
+https://developer.apple.com/documentation/usernotifications/sending-notification-requests-to-apns
+
+Used instead of the legacy binary protocol (see apns.py) for apps with APNS_AUTH_KEY set in
+UNIVERSAL_NOTIFICATIONS_MOBILE_APPS[app_id]. All notifications sent at once to an app are multiplexed
+over a single HTTP/2 connection (at most UNIVERSAL_NOTIFICATIONS_APNS_HTTP2_CONCURRENCY at the same time).
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import jwt
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+
+from universal_notifications.backends.push.apns import APNSError
+from universal_notifications.backends.push.utils import PushTimeout, get_app_settings, get_deadline, get_remaining_time
+
+PRODUCTION_HOST = "https://api.push.apple.com"
+SANDBOX_HOST = "https://api.sandbox.push.apple.com"
+# APNS rejects tokens older than an hour and refreshing them more often than every 20 minutes
+TOKEN_LIFETIME = 50 * 60
+
+_tokens = {}  # {app_id: (authentication token, time of issue)}
+_lock = threading.Lock()
+
+
+class APNSHTTP2Error(APNSError):
+    def __init__(self, status, reason):
+        super(APNSHTTP2Error, self).__init__(status, reason)
+        self.status = status  # HTTP status code, None if the request has not been sent
+        self.reason = reason
+
+
+def _get_required_setting(app_settings, name):
+    value = app_settings.get(name)
+    if not value:
+        raise ImproperlyConfigured(
+            'You need to set UNIVERSAL_NOTIFICATIONS_MOBILE_APPS[app_id]["%s"] '
+            'to send messages through APNS HTTP/2 API.' % name
+        )
+    return value
+
+
+def _read_auth_key(auth_key):
+    if auth_key.lstrip().startswith("-----BEGIN"):
+        return auth_key  # key itself instead of path to the .p8 file
+    try:
+        with open(auth_key, "r") as f:
+            return f.read()
+    except Exception as e:
+        raise ImproperlyConfigured("The APNS auth key file at %r is not readable: %s" % (auth_key, e))
+
+
+def get_auth_token(app_id):
+    """Returns JWT used to authenticate requests - token is signed again after TOKEN_LIFETIME."""
+    with _lock:
+        token, issued_at = _tokens.get(app_id, (None, 0))
+        if token and time.time() - issued_at < TOKEN_LIFETIME:
+            return token
+
+        app_settings = get_app_settings(app_id) or {}
+        key = _read_auth_key(_get_required_setting(app_settings, "APNS_AUTH_KEY"))
+        issued_at = int(time.time())
+        token = jwt.encode({"iss": _get_required_setting(app_settings, "APNS_TEAM_ID"), "iat": issued_at}, key,
+                           algorithm="ES256", headers={"kid": _get_required_setting(app_settings, "APNS_AUTH_KEY_ID")})
+        _tokens[app_id] = (token, issued_at)
+        return token
+
+
+def get_host(app_settings):
+    if app_settings.get("APNS_HTTP2_HOST"):
+        return app_settings["APNS_HTTP2_HOST"]
+    return SANDBOX_HOST if app_settings.get("APNS_USE_SANDBOX") else PRODUCTION_HOST
+
+
+def get_headers(app_id, expiration, priority, push_type):
+    app_settings = get_app_settings(app_id) or {}
+    return {
+        "authorization": "bearer {}".format(get_auth_token(app_id)),
+        "apns-topic": _get_required_setting(app_settings, "APNS_TOPIC"),
+        "apns-push-type": push_type,
+        "apns-expiration": str(expiration),
+        "apns-priority": str(priority),
+    }
+
+
+async def _send_to_app(app_id, tokens, payload, headers, semaphore, deadline=None):
+    timeout = get_remaining_time(deadline, getattr(settings, "UNIVERSAL_NOTIFICATIONS_APNS_HTTP2_TIMEOUT", 10))
+    async with httpx.AsyncClient(base_url=get_host(get_app_settings(app_id)), http1=False, http2=True,
+                                 timeout=timeout) as client:
+        async def post(token):
+            async with semaphore:
+                return await client.post("/3/device/{}".format(token), content=payload, headers=headers)
+
+        async def send(token):
+            try:
+                # waiting for the semaphore counts towards the deadline as well
+                response = await asyncio.wait_for(post(token), get_remaining_time(deadline))
+            except asyncio.TimeoutError:
+                return PushTimeout("Not sent before the timeout")
+            except httpx.HTTPError as e:
+                return APNSHTTP2Error(None, str(e))
+
+            if response.status_code == 200:
+                return None
+            try:
+                reason = response.json().get("reason")
+            except ValueError:
+                reason = response.text
+            return APNSHTTP2Error(response.status_code, reason)
+
+        return await asyncio.gather(*[send(token) for token in tokens])
+
+
+async def _send(requests, deadline=None):
+    semaphore = asyncio.Semaphore(getattr(settings, "UNIVERSAL_NOTIFICATIONS_APNS_HTTP2_CONCURRENCY", 100))
+    return await asyncio.gather(*[_send_to_app(*request, semaphore=semaphore, deadline=deadline)
+                                  for request in requests])
+
+
+def _run(coroutine):
+    """Runs coroutine in a new event loop - in a separate thread if the calling thread already runs one
+    (i.e. called from async code, asyncio.run cannot be nested); the calling thread is blocked until it is done."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def apns_http2_send(devices, payload, expiration, priority=10, push_type="alert", timeout=None):
+    """Sends an already prepared payload (see apns._apns_prepare_payload) to devices.
+
+    Returns list of errors (APNSHTTP2Error or None if notification has been accepted) for each device,
+    PushTimeout for devices which have not been sent to within timeout (seconds, if given).
+    Blocks until all notifications are sent, also when called from a running event loop (see _run).
+    """
+    deadline = get_deadline(timeout)
+    devices = list(devices)
+    devices_by_app = {}
+    for index, device in enumerate(devices):
+        devices_by_app.setdefault(device.app_id, []).append(index)
+
+    requests = []
+    for app_id, indexes in devices_by_app.items():
+        headers = get_headers(app_id, expiration, priority, push_type)
+        requests.append((app_id, [devices[i].notification_token for i in indexes], payload, headers))
+
+    results = [None] * len(devices)
+    for indexes, errors in zip(devices_by_app.values(), _run(_send(requests, deadline))):
+        for index, error in zip(indexes, errors):
+            results[index] = error
+    return results
+
+
+def clear_auth_tokens(**kwargs):
+    if kwargs.get("setting", "UNIVERSAL_NOTIFICATIONS_MOBILE_APPS") == "UNIVERSAL_NOTIFICATIONS_MOBILE_APPS":
+        with _lock:
+            _tokens.clear()
+
+
+setting_changed.connect(clear_auth_tokens)
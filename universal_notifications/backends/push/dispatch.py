@@ -0,0 +1,136 @@
+"""
+Sending push notifications to many devices at once
+
+Devices are grouped by platform and passed to the platform bulk senders (which group them by app_id),
+so a notification is sent with a few requests instead of one request (or connection) per device.
+
+With UNIVERSAL_NOTIFICATIONS_PUSH_CONCURRENT platforms (and batches of devices) are sent concurrently in a thread
+pool, so a slow provider does not delay the others.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+from django.conf import settings
+from django.utils.encoding import force_str
+
+from universal_notifications.backends.push.apns import apns_send_bulk_message
+from universal_notifications.backends.push.fcm import fcm_send_bulk_message
+from universal_notifications.backends.push.gcm import gcm_send_bulk_message
+from universal_notifications.backends.push.utils import PushTimeout  # NOQA (imported from here before)
+from universal_notifications.models import Device
+from universal_notifications.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+
+def _apns_send(devices, message, description, data, timeout=None):
+    return apns_send_bulk_message(devices, message, description, data, timeout=timeout)
+
+
+def _fcm_send(devices, message, description, data, timeout=None):
+    return fcm_send_bulk_message(devices, message, data, timeout=timeout)
+
+
+def _gcm_send(devices, message, description, data, timeout=None):
+    return gcm_send_bulk_message(devices, message, data, timeout=timeout)
+
+
+PLATFORM_SENDERS = {
+    Device.PLATFORM_IOS: _apns_send,
+    Device.PLATFORM_FCM: _fcm_send,
+    Device.PLATFORM_GCM: _gcm_send,
+}
+
+
+def group_by_platform(devices):
+    """Returns {platform: [device indexes]} of active devices."""
+    groups = {}
+    for index, device in enumerate(devices):
+        if device.is_active and device.platform in PLATFORM_SENDERS:
+            groups.setdefault(device.platform, []).append(index)
+    return groups
+
+
+def get_platform_concurrency(platform):
+    return getattr(settings, "UNIVERSAL_NOTIFICATIONS_PUSH_CONCURRENCY", {}).get(platform, 2)
+
+
+def get_platform_timeout(platform):
+    return getattr(settings, "UNIVERSAL_NOTIFICATIONS_PUSH_TIMEOUTS", {}).get(platform, 30)
+
+
+def _send_concurrently(devices, groups, message, description, data, results):
+    """Sends batches of devices (UNIVERSAL_NOTIFICATIONS_PUSH_DISPATCH_BATCH_SIZE) in a thread pool - at most
+    get_platform_concurrency() batches of a platform at once. Errors & timeouts are stored as results of devices.
+
+    Platform timeout is passed to the senders, which limit their requests with it. A batch whose sender has not
+    returned within the timeout gets PushTimeout results - results returned by the sender later are dropped.
+    """
+    batch_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_PUSH_DISPATCH_BATCH_SIZE", 1000)
+    limits = {platform: get_platform_concurrency(platform) for platform in groups}
+    semaphores = {platform: threading.BoundedSemaphore(limit) for platform, limit in limits.items()}
+
+    def send(platform, indexes):
+        with semaphores[platform]:
+            # senders stop sending (and return PushTimeout for remaining devices) when the platform timeout passes
+            timeout = max(0, start + get_platform_timeout(platform) - time.monotonic())
+            return PLATFORM_SENDERS[platform]([devices[i] for i in indexes], message, description, data,
+                                              timeout=timeout)
+
+    executor = ThreadPoolExecutor(max_workers=sum(limits.values()), thread_name_prefix="push-dispatch")
+    start = time.monotonic()
+    try:
+        futures = [(platform, indexes, executor.submit(send, platform, indexes))
+                   for platform, platform_indexes in groups.items()
+                   for indexes in chunked(platform_indexes, batch_size)]
+        for platform, indexes, future in futures:
+            timeout = get_platform_timeout(platform)
+            try:
+                batch_results = future.result(timeout=max(0, start + timeout - time.monotonic()))
+            except FuturesTimeoutError:
+                future.cancel()
+                # the sender may still be finishing its last request - its results (e.g. invalid tokens
+                # to deactivate) are not returned
+                logger.warning("Sending push notifications to %s devices timed out, results of %s devices dropped",
+                               platform, len(indexes))
+                batch_results = [PushTimeout("Not sent within {} seconds".format(timeout))] * len(indexes)
+            except Exception as e:
+                logger.exception("Sending push notifications to %s devices failed", platform)
+                batch_results = [e] * len(indexes)
+
+            for index, result in zip(indexes, batch_results):
+                results[index] = result
+    finally:
+        # do not wait for timed out requests
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def send_bulk_message(devices, message, description="", concurrent=None, **data):
+    """Sends message to devices (same arguments as Device.send_message).
+
+    If concurrent (default: UNIVERSAL_NOTIFICATIONS_PUSH_CONCURRENT), platforms are sent in parallel
+    and exceptions (or PushTimeout) are returned as results of devices instead of being raised.
+
+    Returns list of results for each device - as returned by the platform bulk sender,
+    False for inactive devices & devices of unknown platforms.
+    """
+    message = force_str(message)
+    description = force_str(description)
+    devices = list(devices)
+    results = [False] * len(devices)
+    groups = group_by_platform(devices)
+    if concurrent is None:
+        concurrent = getattr(settings, "UNIVERSAL_NOTIFICATIONS_PUSH_CONCURRENT", False)
+
+    if concurrent and groups:
+        _send_concurrently(devices, groups, message, description, data, results)
+        return results
+
+    for platform, indexes in groups.items():
+        platform_results = PLATFORM_SENDERS[platform]([devices[i] for i in indexes], message, description, data)
+        for index, result in zip(indexes, platform_results):
+            results[index] = result
+    return results
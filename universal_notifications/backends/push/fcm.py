@@ -1,7 +1,16 @@
 # Send to single device.
+import logging
+
+from django.conf import settings
 from pyfcm import FCMNotification
+from pyfcm.errors import FCMError
+from requests.exceptions import RequestException, Timeout
+
+from universal_notifications.backends.push.utils import (PushTimeout, get_app_settings, get_deadline,
+                                                         get_remaining_time)
+from universal_notifications.utils import chunked
 
-from universal_notifications.backends.push.utils import get_app_settings
+logger = logging.getLogger(__name__)
 
 
 def fcm_send_message(device, message, data=None):
@@ -16,3 +25,54 @@ def fcm_send_message(device, message, data=None):
         message_body=message,
         data_message=data
     )
+
+
+def fcm_send_bulk_message(devices, message, data=None, timeout=None):
+    """Sends message to many devices - one client per app, up to FCM multicast limit of tokens per request.
+
+    Returns list of FCM results (dicts with "message_id" or "error") for each device,
+    None for inactive devices and devices of apps without FCM_API_KEY.
+    If timeout (seconds) is given, requests are limited to the time left and PushTimeout is returned
+    for devices which have not been sent to in time.
+    Failed requests do not stop sending to other devices - the error (FCMError or RequestException) is returned
+    for each device of the failed request.
+    """
+    deadline = get_deadline(timeout)
+    batch_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_FCM_BATCH_SIZE", FCMNotification.FCM_MAX_RECIPIENTS)
+    devices = list(devices)
+    results = [None] * len(devices)
+    devices_by_app = {}
+    for index, device in enumerate(devices):
+        if device.is_active:
+            devices_by_app.setdefault(device.app_id, []).append(index)
+
+    for app_id, indexes in devices_by_app.items():
+        api_key = (get_app_settings(app_id) or {}).get('FCM_API_KEY')
+        if not api_key:
+            continue
+
+        push_service = FCMNotification(api_key=api_key)
+        for chunk in chunked(indexes, batch_size):
+            kwargs = {}
+            if deadline is not None:
+                kwargs["timeout"] = get_remaining_time(deadline)
+            try:
+                if kwargs.get("timeout") == 0:
+                    raise Timeout()
+                response = push_service.notify_multiple_devices(
+                    registration_ids=[devices[i].notification_token for i in chunk],
+                    message_body=message,
+                    data_message=data,
+                    **kwargs
+                )
+                chunk_results = response["results"]
+            except Timeout:
+                chunk_results = [PushTimeout("Not sent within {} seconds".format(timeout))] * len(chunk)
+            except (FCMError, RequestException, KeyError) as e:
+                logger.warning("Sending FCM notifications to %s devices of app %s failed: %r", len(chunk), app_id, e)
+                error = e if isinstance(e, (FCMError, RequestException)) else FCMError(e)
+                chunk_results = [error] * len(chunk)
+
+            for index, result in zip(chunk, chunk_results):
+                results[index] = result
+    return results
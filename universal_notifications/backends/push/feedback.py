@@ -0,0 +1,75 @@
+"""
+Push providers feedback
+
+Responses of the bulk senders are checked for invalid (expired, unregistered) tokens and such devices are
+deactivated, so notifications are not sent to them again. Numbers of deactivated devices (per platform)
+are counted in the process - see get_feedback_stats().
+"""
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+
+from universal_notifications.backends.push.apns import APNSServerError
+from universal_notifications.backends.push.gcm import GCM_INVALID_TOKEN_ERRORS
+from universal_notifications.models import Device
+
+logger = logging.getLogger(__name__)
+
+APNS_INVALID_TOKEN_STATUS = 8
+# DeviceTokenNotForTopic is not included - APNS returns it for every token when APNS_TOPIC is misconfigured
+APNS_INVALID_TOKEN_REASONS = {"BadDeviceToken", "Unregistered"}
+
+_stats = Counter()  # {platform: number of deactivated devices}
+_lock = threading.Lock()
+
+
+def is_invalid_token(platform, result):
+    """Checks result returned for a device by the bulk sender of the platform."""
+    if platform == Device.PLATFORM_IOS:
+        if isinstance(result, APNSServerError):
+            return result.status == APNS_INVALID_TOKEN_STATUS
+        return getattr(result, "reason", None) in APNS_INVALID_TOKEN_REASONS  # HTTP/2 API
+    if isinstance(result, dict):  # FCM & GCM
+        return result.get("error") in GCM_INVALID_TOKEN_ERRORS
+    return False
+
+
+def deactivate_devices(devices):
+    """Marks devices as inactive with a single query, returns number of deactivated devices per platform."""
+    counts = Counter()
+    pks = []
+    for device in devices:
+        device.is_active = False
+        counts[device.platform] += 1
+        if device.pk is not None:
+            pks.append(device.pk)
+
+    if pks:
+        Device.objects.filter(pk__in=pks).update(is_active=False)
+    if counts:
+        logger.info("Deactivated devices with invalid tokens: {}".format(dict(counts)))
+        with _lock:
+            _stats.update(counts)
+    return counts
+
+
+def prune_devices(devices, results):
+    """Deactivates devices for which the providers reported invalid tokens (results as returned by
+    dispatch.send_bulk_message). Returns number of deactivated devices per platform."""
+    if not getattr(settings, "UNIVERSAL_NOTIFICATIONS_PUSH_PRUNE_DEVICES", True):
+        return Counter()
+    return deactivate_devices([device for device, result in zip(devices, results)
+                               if device.is_active and is_invalid_token(device.platform, result)])
+
+
+def get_feedback_stats():
+    """Returns number of devices deactivated (per platform) since the process start (or reset_feedback_stats)."""
+    with _lock:
+        return dict(_stats)
+
+
+def reset_feedback_stats():
+    with _lock:
+        _stats.clear()
@@ -4,11 +4,21 @@ Previously known as C2DM
 Documentation is available on the Android Developer website:
 https://developer.android.com/google/gcm/index.html
 """
+import json
+import logging
+import socket
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import urlsplit
+
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_str
 from push_notifications import NotificationError
 from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 
-from universal_notifications.backends.push.utils import get_app_settings
+from universal_notifications.backends.push.utils import (PushTimeout, get_app_settings, get_deadline,
+                                                         get_remaining_time)
+from universal_notifications.utils import chunked
 
 try:
     from urllib.parse import urlencode
@@ -20,6 +30,11 @@ except ImportError:
     from urllib2 import Request, urlopen
 
 
+logger = logging.getLogger(__name__)
+
+GCM_INVALID_TOKEN_ERRORS = {"NotRegistered", "InvalidRegistration"}
+
+
 class GCMError(NotificationError):
     pass
 
@@ -81,6 +96,128 @@ def gcm_send_message(device, message, data=None, collapse_key=None, delay_while_
     args = data, collapse_key, delay_while_idle, time_to_live
     try:
         return _gcm_send_plain(device, *args)
-    except GCMError:
-        # TODO: check error and maybe deactivate user
+    except GCMError as e:
+        if force_str(e.args[0]).replace("Error=", "", 1) in GCM_INVALID_TOKEN_ERRORS:
+            from universal_notifications.backends.push.feedback import deactivate_devices
+
+            deactivate_devices([device])
         return False
+
+
+class GCMConnection(object):
+    """Keep-alive HTTP connection to GCM_POST_URL - reopened (and request retried once) if it has been closed
+    before the request was sent."""
+
+    def __init__(self, url):
+        url = urlsplit(url)
+        connection_class = HTTPSConnection if url.scheme == "https" else HTTPConnection
+        self.connection = connection_class(url.netloc, timeout=self.get_default_timeout())
+        self.path = url.path or "/"
+        if url.query:
+            self.path += "?" + url.query
+
+    def get_default_timeout(self):
+        return getattr(settings, "UNIVERSAL_NOTIFICATIONS_GCM_TIMEOUT", 30)
+
+    def set_timeout(self, timeout):
+        """Sets timeout of socket operations (of the open connection and connections opened later)."""
+        self.connection.timeout = timeout
+        if self.connection.sock is not None:
+            self.connection.sock.settimeout(timeout)
+
+    def post(self, data, headers):
+        """Sends the request, it is retried only if it could not have been sent through a kept-alive connection
+        (failures after the request has been sent are raised - GCM may have sent the notifications already)."""
+        reused = self.connection.sock is not None
+        try:
+            self.connection.request("POST", self.path, data, headers)
+        except (HTTPException, ConnectionError):
+            self.connection.close()
+            if not reused:
+                raise
+            self.connection.request("POST", self.path, data, headers)
+
+        try:
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (HTTPException, ConnectionError):
+            self.connection.close()
+            raise
+
+    def close(self):
+        self.connection.close()
+
+
+def gcm_send_bulk_message(devices, message, data=None, collapse_key=None, delay_while_idle=False, time_to_live=0,
+                          timeout=None):
+    """
+    Sends a GCM notification to many devices as json data with registration_ids
+    (UNIVERSAL_NOTIFICATIONS_GCM_BATCH_SIZE per request) over a single keep-alive connection.
+
+    Returns list of GCM results (dicts with "message_id" or "error") for each device, None for inactive devices.
+    Failed requests do not stop sending to other devices - GCMError (or ImproperlyConfigured if the app has
+    no GCM_API_KEY) is returned for each device of the failed request.
+    If timeout (seconds) is given, requests are limited to the time left and PushTimeout is returned
+    for devices which have not been sent to in time.
+    """
+    deadline = get_deadline(timeout)
+    values = {"data": dict(data or {}, message=message)}
+    if collapse_key:
+        values["collapse_key"] = collapse_key
+
+    if delay_while_idle:
+        values["delay_while_idle"] = True
+
+    if time_to_live:
+        values["time_to_live"] = int(time_to_live)
+
+    batch_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_GCM_BATCH_SIZE", 1000)
+    devices = list(devices)
+    results = [None] * len(devices)
+    devices_by_app = {}
+    for index, device in enumerate(devices):
+        if device.is_active:
+            devices_by_app.setdefault(device.app_id, []).append(index)
+
+    connection = GCMConnection(SETTINGS["GCM_POST_URL"])
+    try:
+        for app_id, indexes in devices_by_app.items():
+            key = (get_app_settings(app_id) or {}).get('GCM_API_KEY')
+            if not key:
+                logger.error("No GCM API key set for app %s", app_id)
+                error = ImproperlyConfigured("No GCM API key set")
+                for index in indexes:
+                    results[index] = error
+                continue
+
+            for chunk in chunked(indexes, batch_size):
+                values["registration_ids"] = [devices[i].notification_token for i in chunk]
+                body = json.dumps(values).encode("utf-8")
+                try:
+                    if deadline is not None:
+                        remaining = get_remaining_time(deadline, connection.get_default_timeout())
+                        if not remaining:
+                            raise socket.timeout()
+                        connection.set_timeout(remaining)
+                    status, response = connection.post(body, {
+                        "Content-Type": "application/json",
+                        "Authorization": "key=%s" % (key),
+                        "Content-Length": str(len(body)),
+                    })
+                    if status != 200:
+                        raise GCMError(status, response)
+                    chunk_results = json.loads(response.decode("utf-8"))["results"]
+                except socket.timeout:
+                    connection.close()
+                    chunk_results = [PushTimeout("Not sent within {} seconds".format(timeout))] * len(chunk)
+                except (GCMError, HTTPException, OSError, ValueError, KeyError) as e:
+                    logger.warning("Sending GCM notifications to %s devices of app %s failed: %r",
+                                   len(chunk), app_id, e)
+                    error = e if isinstance(e, GCMError) else GCMError(e)
+                    chunk_results = [error] * len(chunk)
+
+                for index, result in zip(chunk, chunk_results):
+                    results[index] = result
+    finally:
+        connection.close()
+    return results
@@ -1,5 +1,24 @@
+import time
+
 from django.conf import settings
 
 
+class PushTimeout(Exception):
+    """Result for devices which have not been sent to within the platform timeout."""
+
+
 def get_app_settings(app_id):
     return getattr(settings, "UNIVERSAL_NOTIFICATIONS_MOBILE_APPS", {}).get(app_id)
+
+
+def get_deadline(timeout):
+    """Returns time.monotonic() after which bulk senders stop sending, None if there is no timeout."""
+    return None if timeout is None else time.monotonic() + timeout
+
+
+def get_remaining_time(deadline, default=None):
+    """Returns seconds left to the deadline (never more than default), 0 if it has passed."""
+    if deadline is None:
+        return default
+    remaining = max(0, deadline - time.monotonic())
+    return remaining if default is None else min(default, remaining)
@@ -7,10 +7,19 @@ class SMSEngineAbtract(object):
     def get_service_number(self):
         return ''
 
+    def get_service_numbers(self, count):
+        """Returns service numbers for `count` new receivers."""
+        return [self.get_service_number() for i in range(count)]
+
     def add_to_queue(self, obj):
         self.send(obj.message)
         obj.message.save()
 
+    def add_to_queue_bulk(self, objs):
+        """Adds many pending messages (created with bulk_create) to the queue."""
+        for obj in objs:
+            self.add_to_queue(obj)
+
     def send(self, obj, **kwargs):
         raise NotImplementedError
 
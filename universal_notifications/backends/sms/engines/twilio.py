@@ -1,7 +1,14 @@
 from __future__ import absolute_import
 
+import heapq
+import threading
+import time
+
 import phonenumbers
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.signals import post_delete, post_save
 from redis import StrictRedis
 from rest_framework.renderers import JSONRenderer
 from twilio.base.exceptions import TwilioException
@@ -23,27 +30,102 @@ def get_twilio_client(lookups=False):
                   settings.UNIVERSAL_NOTIFICATIONS_TWILIO_TOKEN)
 
 
+class ServiceNumberPool(object):
+    """Weighted allocation of service numbers to new receivers.
+
+    Numbers are loaded once per UNIVERSAL_NOTIFICATIONS_TWILIO_SERVICE_NUMBERS_CACHE_TIMEOUT seconds (and after
+    changes of Phone objects in the process), each allocation picks the number with the lowest used_count / rate,
+    so numbers with higher rates get proportionally more receivers. used_count is incremented with a single
+    atomic update per allocation, so concurrent workers do not overwrite each other's counts and the pool is
+    rebalanced with their allocations on every reload.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.heap = None
+        self.loaded_at = None
+
+    def get_timeout(self):
+        return getattr(settings, 'UNIVERSAL_NOTIFICATIONS_TWILIO_SERVICE_NUMBERS_CACHE_TIMEOUT', 60)
+
+    def load(self):
+        self.heap = []
+        for number, rate, used_count in Phone.objects.values_list('number', 'rate', 'used_count'):
+            rate = max(rate, 1)
+            self.heap.append(((used_count + 1) / rate, number, rate, used_count))
+        heapq.heapify(self.heap)
+        self.loaded_at = time.monotonic()
+
+    def allocate(self, count):
+        """Returns list of `count` service numbers (empty strings if there are no numbers)."""
+        with self.lock:
+            if self.heap is None or time.monotonic() - self.loaded_at > self.get_timeout():
+                self.load()
+            if not self.heap:
+                return [''] * count
+
+            numbers = []
+            for i in range(count):
+                _, number, rate, used_count = self.heap[0]
+                heapq.heapreplace(self.heap, ((used_count + 2) / rate, number, rate, used_count + 1))
+                numbers.append(number)
+
+        increments = {}
+        for number in numbers:
+            increments[number] = increments.get(number, 0) + 1
+        if increments:
+            Phone.objects.filter(number__in=increments).update(used_count=F('used_count') + Case(
+                *[When(number=number, then=Value(increment)) for number, increment in increments.items()],
+                default=Value(0), output_field=IntegerField()))
+        return numbers
+
+
+service_number_pool = ServiceNumberPool()
+
+
+def _clear_service_number_pool(**kwargs):
+    service_number_pool.clear()
+
+
+post_save.connect(_clear_service_number_pool, sender=Phone)
+post_delete.connect(_clear_service_number_pool, sender=Phone)
+setting_changed.connect(_clear_service_number_pool)
+
+
 class Engine(SMSEngineAbtract):
 
     def get_service_number(self):
-        phone = Phone.objects.all().order_by('used_count').first()
-        if not phone:
-            return ''
-        phone.used_count += 1
-        phone.save()
-        return phone.number
+        return service_number_pool.allocate(1)[0]
+
+    def get_service_numbers(self, count):
+        return service_number_pool.allocate(count)
+
+    def notify_dispatcher(self, numbers):
+        """Notifies proxy (see run_twilio_proxy command) about new messages to send from given service numbers."""
+        connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        r = JSONRenderer()
+        channel = getattr(settings, 'UNIVERSAL_NOTIFICATIONS_TWILIO_DISPATCHER_CHANNEL', '__un_twilio_dispatcher')
+        for number in numbers:
+            json_data = r.render({'number': number})
+            connection.publish(channel, RedisMessage(json_data))
 
     def add_to_queue(self, obj):
         if getattr(settings, 'UNIVERSAL_NOTIFICATIONS_TWILIO_ENABLE_PROXY', False):
-            connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
-            r = JSONRenderer()
-            json_data = r.render({'number': obj.from_phone})
-            channel = getattr(settings, 'UNIVERSAL_NOTIFICATIONS_TWILIO_DISPATCHER_CHANNEL', '__un_twilio_dispatcher')
-            connection.publish(channel, RedisMessage(json_data))
+            self.notify_dispatcher([obj.from_phone])
         else:
             self.send(obj.message)
             obj.message.save()
 
+    def add_to_queue_bulk(self, objs):
+        if getattr(settings, 'UNIVERSAL_NOTIFICATIONS_TWILIO_ENABLE_PROXY', False):
+            # one notification per service number
+            self.notify_dispatcher(sorted({obj.from_phone for obj in objs}))
+        else:
+            super(Engine, self).add_to_queue_bulk(objs)
+
     def send(self, obj):
         if not getattr(settings, 'UNIVERSAL_NOTIFICATIONS_TWILIO_API_ENABLED', False):
             self.status = PhoneSent.STATUS_SENT
@@ -0,0 +1,116 @@
+"""
+Rate limiting of service numbers
+
+Token buckets keyed by service number - a number may send `burst` messages at once after being idle and then
+`rate` messages per minute (Phone.rate). With the Redis backend (default) buckets are shared by all processes
+using the same Redis (e.g. run_twilio_proxy workers on several hosts), so the rate of a number is not multiplied
+by the number of workers. The memory backend limits sending within a single process only.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from redis import StrictRedis
+from ws4redis import settings as private_settings
+
+# KEYS[1] - bucket, ARGV[1] - tokens per second, ARGV[2] - capacity
+# takes a token and returns 0 or returns number of seconds to wait for the next token
+# (effects replication is required by Redis < 5 to write after calling TIME)
+TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1])
+local timestamp = tonumber(bucket[2])
+if tokens == nil or timestamp == nil then
+    tokens = capacity
+    timestamp = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class MemoryRateLimiter(object):
+    """Token buckets stored in the process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}  # {key: (tokens, timestamp)}
+
+    def acquire(self, key, rate, capacity):
+        """Takes a token from the bucket (rate - tokens per second). Returns number of seconds to wait
+        for the next token, 0 if the token has been taken."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, timestamp = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0, now - timestamp) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+        return wait
+
+
+class RedisRateLimiter(object):
+    """Token buckets stored in Redis, updated atomically by a Lua script (with the Redis server clock)."""
+
+    def __init__(self):
+        self.connection = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
+        self.script = self.connection.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def acquire(self, key, rate, capacity):
+        return float(self.script(keys=[key], args=[rate, capacity]))
+
+
+RATE_LIMITERS = {
+    "memory": MemoryRateLimiter,
+    "redis": RedisRateLimiter,
+}
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """Returns limiter of UNIVERSAL_NOTIFICATIONS_RATE_LIMIT_BACKEND ("redis" or "memory")."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        backend = getattr(settings, "UNIVERSAL_NOTIFICATIONS_RATE_LIMIT_BACKEND", "redis")
+        _rate_limiter = RATE_LIMITERS[backend]()
+    return _rate_limiter
+
+
+def _reset_rate_limiter(**kwargs):
+    global _rate_limiter
+    _rate_limiter = None
+
+
+setting_changed.connect(_reset_rate_limiter)
+
+
+def wait_for_token(number, rate, burst=None):
+    """Blocks until service number may send a message - rate is number of messages per minute,
+    burst (default: UNIVERSAL_NOTIFICATIONS_RATE_LIMIT_BURST) is number of messages sent at once after idle time."""
+    if burst is None:
+        burst = getattr(settings, "UNIVERSAL_NOTIFICATIONS_RATE_LIMIT_BURST", 1)
+    key = "{}{}".format(getattr(settings, "UNIVERSAL_NOTIFICATIONS_RATE_LIMIT_PREFIX", "__un_rate:"), number)
+    limiter = get_rate_limiter()
+    while True:
+        wait = limiter.acquire(key, rate / 60.0, max(burst, 1))
+        if not wait:
+            return
+        time.sleep(wait)
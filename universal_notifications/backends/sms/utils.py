@@ -42,6 +42,40 @@ except (AttributeError, ImportError):
         else:
             send_message_task(to_number, text, media, priority)
 
+try:
+    __path, __symbol = getattr(settings, 'UNIVERSAL_NOTIFICATIONS_SEND_SMS_BULK_FUNC').rsplit('.', 1)
+    send_sms_bulk = getattr(import_module(__path), __symbol)
+except (AttributeError, ImportError):
+    def send_sms_bulk(to_numbers, text, media=None, priority=9999, send_async=True):
+        """Send the same SMS/MMS to many numbers
+
+        Numbers are processed in chunks (UNIVERSAL_NOTIFICATIONS_SMS_BULK_CHUNK_SIZE) - one task per chunk,
+        receivers & messages are created in bulk. If UNIVERSAL_NOTIFICATIONS_SEND_SMS_FUNC is set, it is called
+        for every number instead.
+
+        Arguments:
+            to_numbers {list} -- phone numbers
+            text {string} -- SMS/MMS text
+
+        Keyword Arguments:
+            media {string} -- path or url to media file (default: {None})
+            priority {number} -- sending order if queued, ascending order (default: {9999})
+        """
+        if getattr(settings, 'UNIVERSAL_NOTIFICATIONS_SEND_SMS_FUNC', None):
+            for number in to_numbers:
+                send_sms(number, text, media=media, priority=priority, send_async=send_async)
+            return
+
+        from universal_notifications.tasks import send_messages_task
+        from universal_notifications.utils import chunked
+
+        chunk_size = getattr(settings, 'UNIVERSAL_NOTIFICATIONS_SMS_BULK_CHUNK_SIZE', 1000)
+        for numbers in chunked(to_numbers, chunk_size):
+            if send_async:
+                send_messages_task.delay(numbers, text, media, priority)
+            else:
+                send_messages_task(numbers, text, media, priority)
+
 try:
     # Wide UCS-4 build
     emoji_pattern = re.compile(u'['
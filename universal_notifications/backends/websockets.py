@@ -2,32 +2,64 @@
 import json
 
 from django.conf import settings
+from redis import StrictRedis
 from rest_framework.renderers import JSONRenderer
-from ws4redis.publisher import RedisPublisher
-from ws4redis.redis_store import RedisMessage
+from ws4redis import settings as ws4redis_settings
+from ws4redis.publisher import RedisPublisher, redis_connection_pool
+from ws4redis.redis_store import RedisMessage, RedisStore
 from ws4redis.subscriber import RedisSubscriber
 
 from universal_notifications.tasks import ws_received_send_signal_task
+from universal_notifications.utils import chunked
 
 
-def publish(user, item=None, additional_data=None):
+def get_message(item=None, additional_data=None):
     if additional_data is None:
         additional_data = {}
-    redis_publisher = RedisPublisher(facility='all', users=[user.email])
-    r = JSONRenderer()
     if item is None:
         data = {}
     else:
         data = item.as_dict()
     data.update(additional_data)
-    data = r.render(data)
-    message = RedisMessage(data)
+    return RedisMessage(JSONRenderer().render(data))
+
+
+def publish(user, item=None, additional_data=None):
+    redis_publisher = RedisPublisher(facility='all', users=[user.email])
+    message = get_message(item, additional_data)
     if getattr(settings, 'TESTING', False):
         # Do not send in tests
         return
     redis_publisher.publish_message(message)
 
 
+def get_user_channel(email, facility='all'):
+    return '{prefix}user:{0}:{facility}'.format(email, prefix=RedisStore.get_prefix(), facility=facility)
+
+
+def publish_bulk(users, item=None, additional_data=None, message=None):
+    """Publishes the same message to many users - message is serialized once (or passed already serialized, see
+    get_message) and published to all user channels through a single Redis connection in pipelines of
+    UNIVERSAL_NOTIFICATIONS_WS_PIPELINE_SIZE commands."""
+    if message is None:
+        message = get_message(item, additional_data)
+    if getattr(settings, 'TESTING', False):
+        # Do not send in tests
+        return
+
+    expire = ws4redis_settings.WS4REDIS_EXPIRE
+    pipeline_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_WS_PIPELINE_SIZE", 1000)
+    connection = StrictRedis(connection_pool=redis_connection_pool)
+    channels = {get_user_channel(user.email) for user in users}
+    for chunk in chunked(channels, pipeline_size):
+        pipeline = connection.pipeline(transaction=False)
+        for channel in chunk:
+            pipeline.publish(channel, message)
+            if expire > 0:
+                pipeline.setex(channel, expire, message)
+        pipeline.execute()
+
+
 class RedisSignalSubscriber(RedisSubscriber):
     def publish_message(self, message, expire=None):
         try:
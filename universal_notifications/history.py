@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Notification history sinks
+
+Sinks receive lists of history records (dicts with NotificationHistory fields) and store them somewhere.
+Configured with UNIVERSAL_NOTIFICATIONS_HISTORY_SINKS (list of dotted paths), for example:
+
+    UNIVERSAL_NOTIFICATIONS_HISTORY_SINKS = [
+        "universal_notifications.history.DatabaseHistorySink",
+        "universal_notifications.history.FileHistorySink",
+    ]
+
+If UNIVERSAL_NOTIFICATIONS_HISTORY_BUFFER_SIZE is set, records are kept in an in-process buffer and written
+once the buffer is full or UNIVERSAL_NOTIFICATIONS_HISTORY_FLUSH_INTERVAL seconds have passed since the first
+buffered record (optionally in a Celery task - UNIVERSAL_NOTIFICATIONS_HISTORY_IN_TASK).
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
+from django.db import connections
+from django.utils.timezone import now
+
+from universal_notifications.models import NotificationHistory
+from universal_notifications.utils import chunked
+
+# history used to be logged directly by universal_notifications.notifications - keep the logger name
+logger = logging.getLogger("universal_notifications.notifications")
+
+
+class HistorySink(object):
+    def write(self, records):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class DatabaseHistorySink(HistorySink):
+    def write(self, records):
+        batch_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_HISTORY_BATCH_SIZE", 500)
+        for chunk in chunked(records, batch_size):
+            NotificationHistory.objects.bulk_create([NotificationHistory(**data) for data in chunk])
+
+
+class LogHistorySink(HistorySink):
+    def write(self, records):
+        for data in records:
+            logger.info("Notification sent: {}".format(data))
+
+
+class FileHistorySink(HistorySink):
+    """Appends records as JSON lines to UNIVERSAL_NOTIFICATIONS_HISTORY_FILE."""
+
+    def __init__(self):
+        self.path = getattr(settings, "UNIVERSAL_NOTIFICATIONS_HISTORY_FILE", None)
+        if not self.path:
+            raise ImproperlyConfigured("Please define UNIVERSAL_NOTIFICATIONS_HISTORY_FILE to use FileHistorySink")
+        self._lock = threading.Lock()
+
+    def write(self, records):
+        created = now()
+        lines = []
+        for data in records:
+            data = dict(data, created=created)
+            lines.append(json.dumps(data, cls=DjangoJSONEncoder) + "\n")
+
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.writelines(lines)
+
+
+class MultipleHistorySink(HistorySink):
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, records):
+        records = list(records)
+        for sink in self.sinks:
+            sink.write(records)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+
+class BufferedHistorySink(HistorySink):
+    """Collects records in memory and writes them to the wrapped sink in batches.
+
+    Buffer is flushed when it reaches `buffer_size` records, when `flush_interval` seconds have passed since
+    the first buffered record (by a timer thread), on interpreter exit and on shutdown of Celery worker processes.
+    With `use_task` records are handed over to a Celery task instead of being written in the current process.
+    """
+
+    def __init__(self, sink, buffer_size, flush_interval=None, use_task=False):
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.use_task = use_task
+        self._buffer = []
+        self._first_record_time = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def write(self, records):
+        with self._lock:
+            self._buffer.extend(records)
+            if self._first_record_time is None:
+                self._first_record_time = time.monotonic()
+            if self.flush_interval is not None and self._timer is None and self._buffer:
+                self._timer = threading.Timer(self.flush_interval, self._flush_on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+            should_flush = len(self._buffer) >= self.buffer_size
+            if self.flush_interval is not None:
+                should_flush = should_flush or time.monotonic() - self._first_record_time >= self.flush_interval
+
+        if should_flush:
+            self.flush()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Writing notification history failed")
+        finally:
+            connections.close_all()  # connections of the timer thread
+
+    def flush(self):
+        with self._lock:
+            records, self._buffer = self._buffer, []
+            self._first_record_time = None
+            if self._timer is not None:
+                if self._timer is not threading.current_thread():
+                    self._timer.cancel()
+                self._timer = None
+
+        if records:
+            if self.use_task:
+                from universal_notifications.tasks import save_notification_history_task
+
+                save_notification_history_task.delay(records)
+            else:
+                self.sink.write(records)
+        self.sink.flush()
+
+
+def get_default_sinks_paths():
+    paths = []
+    if getattr(settings, "UNIVERSAL_NOTIFICATIONS_HISTORY_USE_DATABASE", True):
+        paths.append("universal_notifications.history.DatabaseHistorySink")
+    paths.append("universal_notifications.history.LogHistorySink")
+    return paths
+
+
+def import_sink(path):
+    module_path, symbol = path.rsplit(".", 1)
+    return getattr(import_module(module_path), symbol)
+
+
+def create_history_sink(buffered=True):
+    paths = getattr(settings, "UNIVERSAL_NOTIFICATIONS_HISTORY_SINKS", None) or get_default_sinks_paths()
+    sink = MultipleHistorySink([import_sink(path)() for path in paths])
+
+    buffer_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_HISTORY_BUFFER_SIZE", 0)
+    if buffered and buffer_size:
+        sink = BufferedHistorySink(
+            sink, buffer_size,
+            flush_interval=getattr(settings, "UNIVERSAL_NOTIFICATIONS_HISTORY_FLUSH_INTERVAL", 5),
+            use_task=getattr(settings, "UNIVERSAL_NOTIFICATIONS_HISTORY_IN_TASK", False))
+    return sink
+
+
+_history_sink = None
+
+
+def get_history_sink():
+    global _history_sink
+    if _history_sink is None:
+        _history_sink = create_history_sink()
+    return _history_sink
+
+
+def flush_history(**kwargs):
+    if _history_sink is not None:
+        _history_sink.flush()
+
+
+def reset_history_sink(**kwargs):
+    global _history_sink
+    if kwargs.get("setting", "UNIVERSAL_NOTIFICATIONS_HISTORY").startswith("UNIVERSAL_NOTIFICATIONS_HISTORY"):
+        flush_history()
+        _history_sink = None
+
+
+setting_changed.connect(reset_history_sink)
+atexit.register(flush_history)
+
+try:
+    from celery.signals import worker_process_shutdown
+except ImportError:
+    pass
+else:
+    # prefork child processes exit with os._exit(), atexit handlers are not called
+    worker_process_shutdown.connect(flush_history, weak=False)
@@ -3,50 +3,75 @@ import json
 import sys
 import threading
 import traceback
-from time import sleep
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from raven.contrib.django import DjangoClient
 from redis import StrictRedis
 from ws4redis import settings as private_settings
 
+from universal_notifications.backends.sms.rate_limit import wait_for_token
 from universal_notifications.models import Phone, PhonePendingMessages
 
 
 class Queue(threading.Thread):
+    """Sends pending messages of a service number with its rate (shared by all proxy processes, see rate_limit).
+
+    Messages are claimed in batches (UNIVERSAL_NOTIFICATIONS_TWILIO_PROXY_BATCH_SIZE) ordered by priority,
+    so many proxy processes can send messages of the same number. The thread stops when there are no pending
+    messages and it has not been notified about new ones."""
+
     def __init__(self, main, phone):
         self.main = main
         self.phone = phone
+        self.wakeup = threading.Event()
         threading.Thread.__init__(self)
 
+    def notify(self):
+        self.wakeup.set()
+
     def stop(self):
-        if self.phone.number in self.main.queues:
-            self.main.queues.remove(self.phone.number)
+        """Removes queue from the dispatcher, unless it has been notified about new messages in the meantime."""
+        with self.main.lock:
+            if self.wakeup.is_set():
+                return False
+            self.main.queues.pop(self.phone.number, None)
+            return True
+
+    def get_messages(self):
+        batch_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_TWILIO_PROXY_BATCH_SIZE", 10)
+        return PhonePendingMessages.objects.claim(self.phone.number, batch_size)
 
     def check_messages(self):
-        count = 1
-        while count:
-            messages = PhonePendingMessages.objects.filter(from_phone=self.phone.number)
-            count = messages.count()
-            if count:
-                self.process_message(messages[0])
-                sleep(60 / self.phone.rate)
-        else:
-            self.stop()
+        while True:
+            self.wakeup.clear()
+            messages = self.get_messages()
+            if not messages:
+                if self.stop():
+                    return
+                continue
+
+            for message in messages:
+                wait_for_token(self.phone.number, self.phone.rate)
+                # the claim may have expired while waiting for rate limit - skip messages claimed by other consumers
+                if PhonePendingMessages.objects.extend_lease(message):
+                    self.process_message(message)
 
     def process_message(self, message):
-        message.message.send()
-        message.message.save()
-        message.delete()
+        if message.message:
+            message.message.send()
+            message.message.save()
+        PhonePendingMessages.objects.release(message)
 
     def run(self):
         try:
             self.check_messages()
         except Exception:
+            with self.main.lock:
+                self.main.queues.pop(self.phone.number, None)
             info = sys.exc_info()
             raven_conf = getattr(settings, "RAVEN_CONFIG", False)
             if raven_conf and raven_conf.get("dsn"):
+                from raven.contrib.django import DjangoClient  # optional dependency
                 client = DjangoClient(raven_conf.get("dsn"))
                 exc_type, exc_value, exc_traceback = info
                 error = str(traceback.format_exception(exc_type, exc_value, exc_traceback))
@@ -58,17 +83,38 @@ class Queue(threading.Thread):
 class Command(BaseCommand):
     args = ""
     help = "Run twilio proxy"
-    queues = []
+
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        self.queues = {}  # {number: Queue}
+        self.lock = threading.Lock()
 
     def create_queue(self, phone):
-        if phone.number not in self.queues:
+        with self.lock:
+            if phone.number in self.queues:
+                self.queues[phone.number].notify()
+                return
             t = Queue(self, phone)
-            t.start()
-            self.queues.append(phone.number)
+            self.queues[phone.number] = t
+        t.start()
+
+    def dispatch(self, number):
+        """Starts (or wakes up) queue of the service number."""
+        with self.lock:
+            queue = self.queues.get(number)
+            if queue:
+                queue.notify()
+                return
+
+        try:
+            phone = Phone.objects.get(number=number)
+        except Phone.DoesNotExist:
+            return
+        self.create_queue(phone)
 
     def handle(self, *args, **options):
         r = StrictRedis(**private_settings.WS4REDIS_CONNECTION)
-        p = r.pubsub()
+        p = r.pubsub(ignore_subscribe_messages=True)
         channel = getattr(settings, "UNIVERSAL_NOTIFICATIONS_TWILIO_DISPATCHER_CHANNEL", "__un_twilio_dispatcher")
         p.subscribe(channel)
 
@@ -76,17 +122,11 @@ class Command(BaseCommand):
         for phone in phones:
             self.create_queue(phone)
 
-        while True:
-            message = p.get_message()
-            if message:
-                try:
-                    m = json.loads(message["data"])
-                    if m.get("number"):
-                        try:
-                            phone = Phone.objects.get(number=m["number"])
-                            self.create_queue(phone)
-                        except Phone.DoesNotExist:
-                            pass
-                except (TypeError, ValueError):
-                    pass
-            sleep(0.001)  # be nice to the system :)
+        # blocks until a message is published
+        for message in p.listen():
+            try:
+                m = json.loads(message["data"])
+                if m.get("number"):
+                    self.dispatch(m["number"])
+            except (AttributeError, TypeError, ValueError):
+                pass
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 4.2.30 on 2026-10-18 12:51
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('universal_notifications', '0008_auto_20170704_0810'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='phonependingmessages',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='phonependingmessages',
+            index=models.Index(fields=['from_phone', 'priority', 'created'], name='un_pending_queue_idx'),
+        ),
+    ]
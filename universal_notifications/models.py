@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
+from datetime import timedelta
+
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
-from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.db import connections, models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
 from django.utils.encoding import force_str
 from phonenumbers import NumberParseException
 
@@ -225,11 +230,61 @@ class PhoneReceived(models.Model):
 post_save.connect(phone_received_post_save, sender=PhoneReceived)
 
 
+class PhonePendingMessagesManager(models.Manager):
+
+    def get_locked_until(self, now):
+        timeout = getattr(settings, "UNIVERSAL_NOTIFICATIONS_TWILIO_PROXY_VISIBILITY_TIMEOUT", 300)
+        return now + timedelta(seconds=timeout)
+
+    def claim(self, from_phone, count):
+        """Claims up to `count` pending messages of the service number, ordered by priority.
+
+        Claimed messages are hidden from other consumers for UNIVERSAL_NOTIFICATIONS_TWILIO_PROXY_VISIBILITY_TIMEOUT
+        seconds - they should be deleted once sent, messages of crashed consumers are claimed again after the timeout.
+        Rows locked by other consumers are skipped (SELECT ... FOR UPDATE SKIP LOCKED) on databases supporting it,
+        on other databases the conditional update ensures each message is claimed by one consumer only.
+        """
+        now = timezone.now()
+        locked_until = self.get_locked_until(now)
+        available = Q(locked_until__isnull=True) | Q(locked_until__lte=now)
+        with transaction.atomic(using=self.db):
+            messages = self.filter(available, from_phone=from_phone).order_by("priority", "created", "id")
+            if connections[self.db].features.has_select_for_update_skip_locked:
+                messages = messages.select_for_update(skip_locked=True)
+            pks = list(messages.values_list("pk", flat=True)[:count])
+            if not pks:
+                return []
+            self.filter(available, pk__in=pks).update(locked_until=locked_until)
+        return list(self.filter(pk__in=pks, locked_until=locked_until).select_related(
+            "message__receiver").order_by("priority", "created", "id"))
+
+    def extend_lease(self, message):
+        """Extends claim of the message (from now on) - returns False if the claim has expired and the message
+        has been claimed by another consumer in the meantime, in such case the message must not be sent."""
+        locked_until = self.get_locked_until(timezone.now())
+        if not self.filter(pk=message.pk, locked_until=message.locked_until).update(locked_until=locked_until):
+            return False
+        message.locked_until = locked_until
+        return True
+
+    def release(self, message):
+        """Deletes sent message, if it is still claimed by the consumer."""
+        return self.filter(pk=message.pk, locked_until=message.locked_until).delete()[0] > 0
+
+
 class PhonePendingMessages(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     from_phone = models.CharField(max_length=30, db_index=True)
     priority = models.IntegerField(default=9999)
     message = models.ForeignKey(PhoneSent, blank=True, null=True, on_delete=models.CASCADE)
+    locked_until = models.DateTimeField(null=True, blank=True)
+
+    objects = PhonePendingMessagesManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["from_phone", "priority", "created"], name="un_pending_queue_idx"),
+        ]
 
     def save(self, *args, **kwargs):
         created = not self.id
@@ -242,7 +297,56 @@ class PhonePendingMessages(models.Model):
         return ret
 
 
+class UnsubscribedUserManager(models.Manager):
+    NOT_UNSUBSCRIBED = (False, {})
+
+    @staticmethod
+    def get_cache_key(user_id):
+        return "universal_notifications:unsubscribed:%s" % user_id
+
+    def get_unsubscriptions(self, user_ids):
+        """Returns {user_id: (unsubscribed_from_all, unsubscribed)} for given users.
+
+        Only needed columns are fetched. If UNIVERSAL_NOTIFICATIONS_SUBSCRIPTIONS_CACHE_TIMEOUT is set, the state
+        is kept in django cache (invalidated when UnsubscribedUser is saved or deleted).
+        """
+        timeout = getattr(settings, "UNIVERSAL_NOTIFICATIONS_SUBSCRIPTIONS_CACHE_TIMEOUT", None)
+        result = {}
+        missing = list(user_ids)
+        if timeout is not None:
+            keys = {self.get_cache_key(user_id): user_id for user_id in missing}
+            for key, value in cache.get_many(keys.keys()).items():
+                result[keys[key]] = value
+            missing = [user_id for user_id in missing if user_id not in result]
+
+        if missing:
+            fetched = dict.fromkeys(missing, self.NOT_UNSUBSCRIBED)
+            rows = self.filter(user_id__in=missing).values_list("user_id", "unsubscribed_from_all", "unsubscribed")
+            for user_id, unsubscribed_from_all, unsubscribed in rows:
+                fetched[user_id] = (unsubscribed_from_all, unsubscribed)
+
+            if timeout is not None:
+                cache.set_many({self.get_cache_key(user_id): value for user_id, value in fetched.items()}, timeout)
+            result.update(fetched)
+
+        return result
+
+    def invalidate_cache(self, user_id):
+        if getattr(settings, "UNIVERSAL_NOTIFICATIONS_SUBSCRIPTIONS_CACHE_TIMEOUT", None) is not None:
+            cache.delete(self.get_cache_key(user_id))
+
+
 class UnsubscribedUser(models.Model):
     user = models.ForeignKey(AUTH_USER_MODEL, on_delete=models.CASCADE)
     unsubscribed_from_all = models.BooleanField(default=False)
     unsubscribed = JSONField(default=dict)
+
+    objects = UnsubscribedUserManager()
+
+
+def unsubscribed_user_changed(sender, instance, **kwargs):
+    UnsubscribedUser.objects.invalidate_cache(instance.user_id)
+
+
+post_save.connect(unsubscribed_user_changed, sender=UnsubscribedUser)
+post_delete.connect(unsubscribed_user_changed, sender=UnsubscribedUser)
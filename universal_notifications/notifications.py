@@ -8,20 +8,33 @@ Sample usage:
 import importlib
 import logging
 import re
+import threading
+import time
+from collections import OrderedDict
 from email.utils import formataddr
+from smtplib import SMTPServerDisconnected
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
-from django.core.mail import EmailMessage
-from django.template import Context, Template
+from django.core.mail import EmailMessage, get_connection
+from django.core.signals import setting_changed
+from django.db import models
+from django.db.models import QuerySet
+from django.template import Context
 from django.template.loader import get_template
-from premailer import Premailer
+from django.utils.encoding import force_str
 
+from universal_notifications.backends.emails.inline_css import get_inlined_template, get_static_cache_paths, inline_css
+from universal_notifications.backends.push.dispatch import send_bulk_message
+from universal_notifications.backends.push.feedback import prune_devices
 from universal_notifications.backends.sms.utils import send_sms
-from universal_notifications.backends.websockets import publish
-from universal_notifications.models import Device, NotificationHistory, UnsubscribedUser
+from universal_notifications.backends.websockets import get_message, publish_bulk
+from universal_notifications.history import get_history_sink
+from universal_notifications.models import Device, UnsubscribedUser
+from universal_notifications.utils import chunked, get_compiled_template, serialize_instance, serialize_instances
 
 logger = logging.getLogger(__name__)
 
@@ -30,11 +43,49 @@ if hasattr(settings, "UNIVERSAL_NOTIFICATIONS_USER_DEFINITIONS_FILE") and \
         hasattr(settings, "UNIVERSAL_NOTIFICATIONS_USER_CATEGORIES_MAPPING"):
     user_definitions = importlib.import_module(settings.UNIVERSAL_NOTIFICATIONS_USER_DEFINITIONS_FILE)
 
+# LRU of {user id: (user type, expiration time)}, see NotificationBase.get_user_type
+_user_types_cache = OrderedDict()
+_user_types_lock = threading.Lock()
+
+
+def get_cached_user_type(user_id):
+    """Returns (True, user type) if the user type is cached and has not expired, (False, None) otherwise."""
+    with _user_types_lock:
+        cached = _user_types_cache.get(user_id)
+        if cached is None:
+            return False, None
+        if cached[1] <= time.monotonic():
+            del _user_types_cache[user_id]
+            return False, None
+        _user_types_cache.move_to_end(user_id)
+        return True, cached[0]
+
+
+def cache_user_type(user_id, user_type, timeout):
+    """Caches user type, least recently used entries are evicted over UNIVERSAL_NOTIFICATIONS_USER_TYPE_CACHE_SIZE."""
+    max_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_USER_TYPE_CACHE_SIZE", 10000)
+    with _user_types_lock:
+        _user_types_cache[user_id] = (user_type, time.monotonic() + timeout)
+        _user_types_cache.move_to_end(user_id)
+        while len(_user_types_cache) > max_size:
+            _user_types_cache.popitem(last=False)
+
+
+def clear_user_types_cache(**kwargs):
+    if kwargs.get("setting", "UNIVERSAL_NOTIFICATIONS_USER").startswith("UNIVERSAL_NOTIFICATIONS_USER"):
+        with _user_types_lock:
+            _user_types_cache.clear()
+
+
+setting_changed.connect(clear_user_types_cache)
+
 
 class NotificationBase(object):
     check_subscription = True
     category = "default"
     PRIORITY_CATEGORY = "system"  # this category will be always sent
+    receivers_chunk_size = None  # stream receivers in chunks, see send_in_chunks
+    _prepared_message = None
 
     @classmethod
     def get_type(cls):
@@ -46,21 +97,61 @@ class NotificationBase(object):
         self.context = context or {}
 
     @classmethod
-    def get_mapped_user_notifications_types_and_categories(cls, user):
-        """Returns a dictionary for given user type:
+    def get_user_type(cls, user):
+        """Returns the first type from UNIVERSAL_NOTIFICATIONS_USER_CATEGORIES_MAPPING matching given user.
 
-        {"notificaiton_type": [categries list]}
-        TODO: use this one in serializer.
+        Result is cached per process for UNIVERSAL_NOTIFICATIONS_USER_TYPE_CACHE_TIMEOUT seconds (if set)
+        in a LRU cache of UNIVERSAL_NOTIFICATIONS_USER_TYPE_CACHE_SIZE users.
         """
+        timeout = getattr(settings, "UNIVERSAL_NOTIFICATIONS_USER_TYPE_CACHE_TIMEOUT", None)
+        if timeout:
+            found, user_type = get_cached_user_type(user.id)
+            if found:
+                return user_type
+
+        user_type = None
+        for mapped_user_type in settings.UNIVERSAL_NOTIFICATIONS_USER_CATEGORIES_MAPPING:
+            if getattr(user_definitions, mapped_user_type)(user):
+                user_type = mapped_user_type
+                break
+
+        if timeout:
+            cache_user_type(user.id, user_type, timeout)
+        return user_type
+
+    @classmethod
+    def get_user_types(cls, users):
+        """Classifies all users in one pass, returns {user.id: user type}."""
+        if not hasattr(settings, "UNIVERSAL_NOTIFICATIONS_USER_CATEGORIES_MAPPING"):
+            return {user.id: None for user in users}
+
+        user_types = {}
+        for user in users:
+            if user.id not in user_types:
+                user_types[user.id] = cls.get_user_type(user)
+        return user_types
+
+    @classmethod
+    def get_user_type_notifications_types_and_categories(cls, user_type):
         if not hasattr(settings, "UNIVERSAL_NOTIFICATIONS_USER_CATEGORIES_MAPPING"):
             notifications = {}
             for key in settings.UNIVERSAL_NOTIFICATIONS_CATEGORIES.keys():
                 notifications[key] = settings.UNIVERSAL_NOTIFICATIONS_CATEGORIES[key].keys()
             return notifications
-        else:
-            for user_type in settings.UNIVERSAL_NOTIFICATIONS_USER_CATEGORIES_MAPPING:
-                if getattr(user_definitions, user_type)(user):
-                    return settings.UNIVERSAL_NOTIFICATIONS_USER_CATEGORIES_MAPPING[user_type]
+        elif user_type is not None:
+            return settings.UNIVERSAL_NOTIFICATIONS_USER_CATEGORIES_MAPPING[user_type]
+
+    @classmethod
+    def get_mapped_user_notifications_types_and_categories(cls, user):
+        """Returns a dictionary for given user type:
+
+        {"notificaiton_type": [categries list]}
+        TODO: use this one in serializer.
+        """
+        user_type = None
+        if hasattr(settings, "UNIVERSAL_NOTIFICATIONS_USER_CATEGORIES_MAPPING"):
+            user_type = cls.get_user_type(user)
+        return cls.get_user_type_notifications_types_and_categories(user_type)
 
     def get_user_categories_for_type(self, user):
         """Check categories available for given user type and this notification type.
@@ -109,9 +200,17 @@ class NotificationBase(object):
         if self.category not in categories.keys():
             raise ImproperlyConfigured("No such category for Universal Notifications: %s: %s." % (
                 self.get_type(), self.category))
-        # check if user is allowed to get notifications from this category
-        for user in self.receivers:
-            if self.category not in self.get_user_categories_for_type(user):
+        # check if user is allowed to get notifications from this category (receivers are classified once,
+        # then categories are checked once per user type)
+        user_types = self.get_user_types(self.receivers)
+        for user_type in set(user_types.values()):
+            categories = self.get_user_type_notifications_types_and_categories(user_type)
+            if not categories:
+                user = next(x for x in self.receivers if user_types[x.id] == user_type)
+                raise ImproperlyConfigured(
+                    "UNIVERSAL NOTIFICATIONS USER CATEGORIES MAPPING: No categories for given user: %s" % user)
+
+            if self.category not in categories[notification_type]:
                 raise ImproperlyConfigured(
                     "User is not allowed to receive notifications from '%s:%s' category"
                     % (self.get_type(), self.category))
@@ -121,47 +220,144 @@ class NotificationBase(object):
         if not self.check_subscription or self.category == self.PRIORITY_CATEGORY:
             return self.receivers
 
-        receivers_ids = (x.id for x in self.receivers)
-        unsubscribed_map = {}
-        for unsubscribed_user in UnsubscribedUser.objects.filter(user__in=receivers_ids):
-            unsubscribed_map[unsubscribed_user.user_id] = unsubscribed_user
-
+        chunk_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_SUBSCRIPTIONS_CHUNK_SIZE", 1000)
         filtered_receivers = []
         ntype = self.get_type().lower()
-        for receiver in self.receivers:
-            unsubscribed_user = unsubscribed_map.get(receiver.id, None)
-            if unsubscribed_user:
-                if unsubscribed_user.unsubscribed_from_all:
+        for receivers in chunked(self.receivers, chunk_size):
+            unsubscriptions = UnsubscribedUser.objects.get_unsubscriptions({x.id for x in receivers})
+            for receiver in receivers:
+                unsubscribed_from_all, unsubscribed = unsubscriptions[receiver.id]
+                if unsubscribed_from_all:
                     continue
-                unsubscribed = unsubscribed_user.unsubscribed.get(ntype, {})
+                unsubscribed = unsubscribed.get(ntype, {})
                 if "all" in unsubscribed or self.category in unsubscribed:
                     continue
-            filtered_receivers.append(receiver)
+                filtered_receivers.append(receiver)
         self.receivers = filtered_receivers
 
+    def get_notification_history_base_data(self):
+        """Returns history fields shared by all receivers of this notification (computed once per send)."""
+        data = {
+            "group": self.get_type(),
+            "klass": self.__class__.__name__,
+            "details": self.get_notification_history_details(),
+            "category": self.category,
+        }
+
+        if hasattr(self.item, "id"):
+            if isinstance(self.item.id, int):
+                content_type = ContentType.objects.get_for_model(self.item)
+                data["content_type_id"] = content_type.id
+                data["object_id"] = self.item.id
+        return data
+
+    def get_notification_history_data(self, receiver, base_data):
+        """Returns history fields for a single receiver - override to customize per-receiver fields."""
+        data = base_data.copy()
+        data["receiver"] = force_str(self.format_receiver_for_notification_history(receiver))
+        return data
+
     def save_notifications(self, prepared_receivers):
-        for receiver in prepared_receivers:
-            data = {
-                "group": self.get_type(),
-                "klass": self.__class__.__name__,
-                "receiver": self.format_receiver_for_notification_history(receiver),
-                "details": self.get_notification_history_details(),
-                "category": self.category,
-            }
-
-            if hasattr(self.item, "id"):
-                if isinstance(self.item.id, int):
-                    content_type = ContentType.objects.get_for_model(self.item)
-                    data["content_type"] = content_type
-                    data["object_id"] = self.item.id
-
-            if getattr(settings, "UNIVERSAL_NOTIFICATIONS_HISTORY", True):
-                if getattr(settings, "UNIVERSAL_NOTIFICATIONS_HISTORY_USE_DATABASE", True):
-                    NotificationHistory.objects.create(**data)
-
-                logger.info("Notification sent: {}".format(data))
+        if not getattr(settings, "UNIVERSAL_NOTIFICATIONS_HISTORY", True):
+            return
+
+        batch_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_HISTORY_BATCH_SIZE", 500)
+        base_data = self.get_notification_history_base_data()
+        history_sink = get_history_sink()
+        for receivers in chunked(prepared_receivers, batch_size):
+            history_sink.write([self.get_notification_history_data(receiver, base_data) for receiver in receivers])
+
+    def get_receivers_chunk_size(self):
+        if self.receivers_chunk_size is not None:
+            return self.receivers_chunk_size
+        return getattr(settings, "UNIVERSAL_NOTIFICATIONS_RECEIVERS_CHUNK_SIZE", None)
+
+    def iter_receivers(self, chunk_size):
+        if isinstance(self.receivers, QuerySet):
+            return self.receivers.iterator(chunk_size=chunk_size)
+        return iter(self.receivers)
+
+    def send_verified(self):
+        """Sends notification to receivers with already verified category & subscriptions.
+
+        Message is prepared once and reused when called again (e.g. for next chunks).
+        """
+        prepared_receivers = self.prepare_receivers()
+        if self._prepared_message is None:
+            self._prepared_message = self.prepare_message()
+        result = self.send_inner(prepared_receivers, self._prepared_message)
+        self.save_notifications(prepared_receivers)
+        return result
+
+    def send_chunk(self, receivers):
+        """Sends notification to a part of receivers (filter -> prepare -> send -> history)."""
+        self.receivers = receivers
+        self.check_category()
+        self.verify_and_filter_receivers_subscriptions()
+        return self.send_verified()
+
+    def send_in_chunks(self, chunk_size):
+        """Streams receivers (list, iterator or QuerySet) in chunks - memory is bounded by the chunk size.
+
+        Used by send() if receivers_chunk_size (or UNIVERSAL_NOTIFICATIONS_RECEIVERS_CHUNK_SIZE) is set.
+        Category & subscriptions are verified per chunk and duplicated receivers are only removed within a chunk.
+        Returns list of send_inner results for each chunk.
+        """
+        self._prepared_message = None
+        all_receivers = self.receivers
+        try:
+            return [self.send_chunk(receivers) for receivers in chunked(self.iter_receivers(chunk_size), chunk_size)]
+        finally:
+            self.receivers = all_receivers
+
+    def get_task_init_kwargs(self):
+        """Additional __init__ arguments for notifications sent in tasks (must be serializable by Celery)."""
+        return {}
+
+    def send_distributed(self, chunk_size=None):
+        """Sends notification in Celery tasks (CELERY_APP_PATH app) - one task per chunk of receivers.
+
+        Category & subscriptions are verified in the current process, then chunks of verified receivers
+        (UNIVERSAL_NOTIFICATIONS_TASK_CHUNK_SIZE, default: 1000) are sent to send_notification_chunk_task.
+        Receivers and item (if it is a model instance) are passed to tasks by primary key, context must be
+        serializable. Returns celery GroupResult.
+        Raises ImproperlyConfigured if CELERY_APP_PATH is not set.
+        """
+        from celery import group
+
+        try:
+            from universal_notifications.tasks import send_notification_chunk_task
+        except ImportError:
+            raise ImproperlyConfigured("CELERY_APP_PATH is required to send notifications in Celery tasks")
+
+        if not chunk_size:
+            chunk_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_TASK_CHUNK_SIZE", 1000)
+
+        notification_path = "%s.%s" % (self.__class__.__module__, self.__class__.__name__)
+        item = serialize_instance(self.item)
+        context = {key: value for key, value in self.context.items() if key != "item"}
+        init_kwargs = self.get_task_init_kwargs()
+        tasks = []
+        all_receivers = self.receivers
+        try:
+            for receivers in chunked(self.iter_receivers(chunk_size), chunk_size):
+                self.receivers = receivers
+                self.check_category()
+                self.verify_and_filter_receivers_subscriptions()
+                if self.receivers:
+                    tasks.append(send_notification_chunk_task.s(
+                        notification_path, item, serialize_instances(self.receivers), context.copy(), init_kwargs))
+        finally:
+            self.receivers = all_receivers
+        return group(tasks).apply_async()
 
     def send(self):
+        chunk_size = self.get_receivers_chunk_size()
+        if chunk_size:
+            return self.send_in_chunks(chunk_size)
+
+        if not isinstance(self.receivers, (list, tuple, set, frozenset, QuerySet)):
+            self.receivers = list(self.receivers)  # iterators are consumed more than once below
         self.check_category()
         self.verify_and_filter_receivers_subscriptions()
         prepared_receivers = self.prepare_receivers()
@@ -176,22 +372,71 @@ class WSNotification(NotificationBase):
     serializer_class = None  # required, DRF serializer
     serializer_many = False
     check_subscription = False
+    # cache serialized item (opt-in), see get_serialization_cache_key
+    cache_serialized_data = False
+    _encoded_message = (None, None)  # (prepared message, message encoded for publishing)
 
     def prepare_receivers(self):
         return set(self.receivers)
 
+    def get_item_identity(self):
+        """Identity of the item used in the serialization cache key, None if the item cannot be cached."""
+        if isinstance(self.item, models.Model) and self.item.pk is not None:
+            return "{}:{}".format(self.item._meta.label, self.item.pk)
+        return None
+
+    def get_item_version(self):
+        """Version of the item used in the serialization cache key (by default taken from the "updated",
+        "modified" or "updated_at" field), None if the item cannot be cached."""
+        for field in ("updated", "modified", "updated_at"):
+            version = getattr(self.item, field, None)
+            if version is not None:
+                return version.isoformat() if hasattr(version, "isoformat") else version
+        return None
+
+    def get_serialization_cache_key(self):
+        if not self.cache_serialized_data:
+            return None
+        identity = self.get_item_identity()
+        version = self.get_item_version()
+        if identity is None or version is None:
+            return None
+        return "universal_notifications:ws:{}.{}:{}:{}".format(
+            self.__class__.__module__, self.__class__.__name__, identity, version)
+
+    def serialize_item(self):
+        """Serializes the item - if cache_serialized_data is set, serialized data is cached (Django cache,
+        UNIVERSAL_NOTIFICATIONS_WS_CACHE_TIMEOUT) per item identity and version."""
+        cache_key = self.get_serialization_cache_key()
+        if cache_key:
+            data = cache.get(cache_key)
+            if data is not None:
+                return data
+
+        data = self.serializer_class(self.item, context=self.get_context(), many=self.serializer_many).data
+        if cache_key:
+            cache.set(cache_key, data, getattr(settings, "UNIVERSAL_NOTIFICATIONS_WS_CACHE_TIMEOUT", 300))
+        return data
+
     def prepare_message(self):
         return {
             "message": self.message,
-            "data": self.serializer_class(self.item, context=self.get_context(), many=self.serializer_many).data
+            "data": self.serialize_item()
         }
 
     def format_receiver_for_notification_history(self, receiver):
         return receiver.email
 
+    def get_encoded_message(self, prepared_message):
+        """Returns message encoded for publishing - encoded once per prepared message (reused for all chunks)."""
+        message, encoded_message = self._encoded_message
+        if message is not prepared_message:
+            encoded_message = get_message(additional_data=prepared_message)
+            self._encoded_message = (prepared_message, encoded_message)
+        return encoded_message
+
     def send_inner(self, prepared_receivers, prepared_message):
-        for receiver in prepared_receivers:
-            publish(receiver, additional_data=prepared_message)
+        publish_bulk(prepared_receivers, message=self.get_encoded_message(prepared_message))
 
     def get_notification_history_details(self):
         return "message: %s, serializer: %s" % (self.message, self.serializer_class.__name__)
@@ -204,6 +449,7 @@ class WSNotification(NotificationBase):
 class SMSNotification(NotificationBase):
     message = None  # required, django template string
     send_async = getattr(settings, "UNIVERSAL_NOTIFICATIONS_SMS_SEND_IN_TASK", True)
+    _last_message = None  # rendered for the last receiver in send_inner
 
     def prepare_receivers(self):
         """Filter out duplicated phone numbers"""
@@ -215,15 +461,38 @@ class SMSNotification(NotificationBase):
 
         return receivers
 
+    def get_message_template(self):
+        return get_compiled_template(self.message)
+
     def prepare_message(self):
-        return Template(self.message).render(Context(self.get_context()))
+        return self.get_message_template().render(Context(self.get_context()))
+
+    def is_context_per_receiver(self):
+        """Checks if prepare_message or get_context are overridden - they are called for every receiver
+        (with self.context["receiver"] set), otherwise the context is built once and only the receiver changes."""
+        cls = type(self)
+        return cls.prepare_message is not SMSNotification.prepare_message or \
+            cls.get_context is not NotificationBase.get_context
 
     def send_inner(self, prepared_receivers, prepared_message):
+        if self.is_context_per_receiver():
+            for receiver in prepared_receivers:
+                self.context["receiver"] = receiver
+                self._last_message = self.prepare_message()
+                send_sms(receiver.phone, self._last_message, send_async=self.send_async)
+            return
+
+        template = self.get_message_template()
+        context = Context(self.get_context())
         for receiver in prepared_receivers:
             self.context["receiver"] = receiver
-            send_sms(receiver.phone, self.prepare_message(), send_async=self.send_async)
+            with context.push(receiver=receiver):
+                self._last_message = template.render(context)
+            send_sms(receiver.phone, self._last_message, send_async=self.send_async)
 
     def get_notification_history_details(self):
+        if self._last_message is not None:
+            return self._last_message
         return self.prepare_message()
 
     @classmethod
@@ -231,6 +500,47 @@ class SMSNotification(NotificationBase):
         return "SMS"
 
 
+class PreparedEmail(object):
+    """Everything EmailNotification needs to build an email which does not depend on the receiver.
+
+    Built once per send (see EmailNotification.prepare_email), so for every receiver the template is only
+    rendered (and CSS inlined, unless the inlined template is cached) and the message is created.
+    """
+
+    def __init__(self, template, context, subject, sender, base_url, use_premailer=True, inlined_template=None,
+                 attachments=None, categories=None, sendgrid_asm=None):
+        self.template = template
+        self.context = context
+        self.subject = subject
+        self.sender = sender
+        self.base_url = base_url
+        self.use_premailer = use_premailer
+        self.inlined_template = inlined_template
+        self.attachments = attachments or []
+        self.categories = categories
+        self.sendgrid_asm = sendgrid_asm
+        self.static_cache_paths = get_static_cache_paths() if use_premailer else None
+
+    def render(self, context):
+        if self.inlined_template:
+            return self.inlined_template.render(context)
+        html = self.template.render(context)
+        if self.use_premailer:
+            html = inline_css(html, self.base_url, self.static_cache_paths)
+        return html
+
+    def get_message(self, subject, html, receiver):
+        email = EmailMessage(subject, html, self.sender, [receiver], attachments=self.attachments)
+        if self.categories:
+            email.categories = self.categories
+
+        if self.sendgrid_asm:
+            email.asm = self.sendgrid_asm
+
+        email.content_subtype = "html"
+        return email
+
+
 class EmailNotification(NotificationBase):
     """Email notification
 
@@ -249,11 +559,15 @@ class EmailNotification(NotificationBase):
     categories = []  # optional
     sendgrid_asm = {}
     use_premailer = None
+    cache_premailer = None  # inline CSS once per template (default: UNIVERSAL_NOTIFICATIONS_PREMAILER_CACHE)
 
     def __init__(self, item, receivers, context=None, attachments=None):
         self.attachments = attachments or []
         super(EmailNotification, self).__init__(item, receivers, context)
 
+    def get_task_init_kwargs(self):
+        return {"attachments": self.attachments}
+
     @classmethod
     def format_receiver(cls, receiver):
         receiver_name = "%s %s" % (receiver.first_name, receiver.last_name)
@@ -271,7 +585,7 @@ class EmailNotification(NotificationBase):
 
     def prepare_subject(self):
         if self.email_subject:
-            return Template(self.email_subject).render(Context(self.get_context()))
+            return get_compiled_template(self.email_subject).render(Context(self.get_context()))
 
     def get_notification_history_details(self):
         return self.email_name
@@ -295,49 +609,77 @@ class EmailNotification(NotificationBase):
     def get_template(self):
         return get_template("emails/email_%s.html" % self.email_name)
 
-    def send_email(self, subject, context, receiver):
+    def get_cache_premailer(self):
+        if self.cache_premailer is not None:
+            return self.cache_premailer
+        return getattr(settings, "UNIVERSAL_NOTIFICATIONS_PREMAILER_CACHE", False)
+
+    def get_use_premailer(self):
+        return getattr(settings, "UNIVERSAL_NOTIFICATIONS_USE_PREMAILER", True) and self.use_premailer is not False
+
+    def prepare_email(self, subject, context):
+        """Returns PreparedEmail - template, sender, CSS inlining & SendGrid settings resolved once per send."""
         template = self.get_template()
-        html = template.render(context)
         # update paths
-        base = context["protocol"] + context["domain"]
-        sender = self.sender or settings.DEFAULT_FROM_EMAIL
-        if getattr(settings, "UNIVERSAL_NOTIFICATIONS_USE_PREMAILER", True) and self.use_premailer is not False:
-            html = html.replace("{settings.STATIC_URL}CACHE/".format(settings=settings),
-                                "{settings.STATIC_ROOT}/CACHE/".format(settings=settings))  # get local file
-            html = Premailer(html,
-                             remove_classes=False,
-                             exclude_pseudoclasses=False,
-                             keep_style_tags=True,
-                             include_star_selectors=True,
-                             strip_important=False,
-                             cssutils_logging_level=logging.CRITICAL,
-                             base_url=base).transform()
+        base_url = context["protocol"] + context["domain"]
+        use_premailer = self.get_use_premailer()
+        inlined_template = None
+        if use_premailer and self.get_cache_premailer():
+            inlined_template = get_inlined_template(template, base_url)
+
+        return PreparedEmail(template, context, subject, self.sender or settings.DEFAULT_FROM_EMAIL, base_url,
+                             use_premailer=use_premailer, inlined_template=inlined_template,
+                             attachments=self.attachments, categories=self.categories,
+                             sendgrid_asm=self.sendgrid_asm)
+
+    def get_email_message(self, subject, context, receiver, prepared_email=None):
+        if prepared_email is None:
+            prepared_email = self.prepare_email(subject, context)
+        html = prepared_email.render(context)
 
         # if subject is not provided, try to extract it from <title> tag
         if not subject:
             self.email_subject = self.__get_title_from_html(html)
             subject = self.prepare_subject()
 
-        email = EmailMessage(subject, html, sender, [receiver], attachments=self.attachments)
-        if self.categories:
-            email.categories = self.categories
+        return prepared_email.get_message(subject, html, receiver)
 
-        if self.sendgrid_asm:
-            email.asm = self.sendgrid_asm
+    def send_email(self, subject, context, receiver):
+        self.get_email_message(subject, context, receiver).send(fail_silently=False)
 
-        email.content_subtype = "html"
-        email.send(fail_silently=False)
+    def send_email_message(self, connection, message):
+        """Sends message through an open connection, reconnects (and retries once) if the server disconnected.
+
+        Messages are passed to the connection one by one, so only the message which failed is sent again
+        after reconnecting - messages delivered before the server disconnected are not duplicated.
+        """
+        try:
+            connection.send_messages([message])
+        except SMTPServerDisconnected:
+            connection.close()
+            connection.open()
+            connection.send_messages([message])
 
     def send_inner(self, prepared_receivers, prepared_message):
+        if not prepared_receivers:
+            return  # i.e. all receivers unsubscribed - do not connect to the server
+
         subject = self.email_subject
         if subject:
             subject = self.prepare_subject()
 
         context = self.get_full_template_context()
         context.update(prepared_message)
-        for receiver in prepared_receivers:
-            context["receiver"] = receiver
-            self.send_email(subject, context, self.format_receiver(receiver))
+        prepared_email = self.prepare_email(subject, context)
+        connection = get_connection(fail_silently=False)
+        connection.open()
+        try:
+            for receiver in prepared_receivers:
+                context["receiver"] = receiver
+                message = self.get_email_message(subject, context, self.format_receiver(receiver), prepared_email)
+                self.send_email_message(connection, message)
+        finally:
+            connection.close()
 
     def __get_title_from_html(self, html):
         m = re.search(r"<title>(.*?)</title>", html, re.MULTILINE | re.IGNORECASE)
@@ -365,18 +707,32 @@ class PushNotification(NotificationBase):
     def prepare_message(self):
         context = Context(self.get_context())
         return {
-            "title": Template(self.title).render(context),
-            "description": Template(self.description).render(context),
+            "title": get_compiled_template(self.title).render(context),
+            "description": get_compiled_template(self.description).render(context),
             "data": self.prepare_body()
         }
 
     def format_receiver_for_notification_history(self, receiver):
         return receiver.email
 
-    def send_inner(self, prepared_receivers, prepared_message):  # TODO
-        for receiver in prepared_receivers:
-            for d in Device.objects.filter(user=receiver, is_active=True):
-                d.send_message(prepared_message["title"], prepared_message["description"], **prepared_message["data"])
+    def get_devices(self, receivers):
+        return Device.objects.filter(user__in=receivers, is_active=True)
+
+    def send_inner(self, prepared_receivers, prepared_message):
+        """Active devices are fetched & sent to in chunks of receivers (UNIVERSAL_NOTIFICATIONS_PUSH_CHUNK_SIZE).
+
+        Devices with tokens reported as invalid by the providers are deactivated.
+        Returns numbers of devices: {"devices": sent to, "deactivated": deactivated}.
+        """
+        chunk_size = getattr(settings, "UNIVERSAL_NOTIFICATIONS_PUSH_CHUNK_SIZE", 1000)
+        counts = {"devices": 0, "deactivated": 0}
+        for receivers in chunked(prepared_receivers, chunk_size):
+            devices = list(self.get_devices(receivers))
+            results = send_bulk_message(devices, prepared_message["title"], prepared_message["description"],
+                                        **prepared_message["data"])
+            counts["devices"] += len(devices)
+            counts["deactivated"] += sum(prune_devices(devices, results).values())
+        return counts
 
     def get_notification_history_details(self):
         return self.prepare_message()
@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 import traceback
+from collections import OrderedDict
 
 import six
 from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+from phonenumbers import NumberParseException
 
 from universal_notifications.backends.sms.base import SMS
-from universal_notifications.backends.sms.utils import clean_text
+from universal_notifications.backends.sms.utils import clean_text, format_phone
+from universal_notifications.history import create_history_sink
 from universal_notifications.models import PhonePendingMessages, PhoneReceivedRaw, PhoneReceiver, PhoneSent
 from universal_notifications.signals import ws_received
+from universal_notifications.utils import deserialize_instance, deserialize_instances
 
 try:
     from django.utils.importlib import import_module
@@ -67,6 +73,59 @@ if CELERY_APP_PATH:
         }
         PhonePendingMessages.objects.create(**data)
 
+    @app.task(ignore_result=True)
+    def send_messages_task(to_numbers, text, media, priority):
+        """Sends the same message to many numbers, see send_sms_bulk"""
+        sms = SMS()
+        numbers = OrderedDict()
+        for number in to_numbers:
+            try:
+                numbers[format_phone(number)] = True
+            except NumberParseException:
+                pass  # invalid numbers are skipped
+        numbers = list(numbers)
+        receivers = {x.number: x for x in PhoneReceiver.objects.filter(number__in=numbers)}
+        missing = [number for number in numbers if number not in receivers]
+        if missing:
+            service_numbers = sms.get_service_numbers(len(missing))
+            PhoneReceiver.objects.bulk_create(
+                [PhoneReceiver(number=number, service_number=format_phone(service_number))
+                 for number, service_number in zip(missing, service_numbers)],
+                ignore_conflicts=True)  # receivers created in the meantime
+            receivers.update((x.number, x) for x in PhoneReceiver.objects.filter(number__in=missing))
+
+        text = six.text_type(clean_text(text))
+        messages = [PhoneSent(receiver=receivers[number], text=text, media_raw=media,
+                              status=PhoneSent.STATUS_FAILED if receivers[number].is_blocked
+                              else PhoneSent.STATUS_QUEUED)
+                    for number in numbers]
+        if connection.features.can_return_rows_from_bulk_insert:
+            PhoneSent.objects.bulk_create(messages)
+        else:
+            # ids are needed for pending messages
+            for obj in messages:
+                obj.save()
+
+        pending_messages = [
+            PhonePendingMessages(from_phone=format_phone(obj.receiver.service_number), priority=priority, message=obj)
+            for obj in messages if obj.status == PhoneSent.STATUS_QUEUED]
+        PhonePendingMessages.objects.bulk_create(pending_messages)
+        sms.add_to_queue_bulk(pending_messages)
+        return len(pending_messages)
+
+    @app.task(ignore_result=True)
+    def save_notification_history_task(records):
+        create_history_sink(buffered=False).write(records)
+
+    @app.task
+    def send_notification_chunk_task(notification_path, item, receivers, context, init_kwargs):
+        """Sends notification to a chunk of already verified receivers, see NotificationBase.send_distributed"""
+        notification_class = import_string(notification_path)
+        receivers = deserialize_instances(receivers)
+        notification = notification_class(deserialize_instance(item), receivers, context, **init_kwargs)
+        notification.send_verified()
+        return len(receivers)
+
     @app.task(ignore_result=True)
     def ws_received_send_signal_task(message_data, channel_emails):
         ws_received.send(sender=None, message_data=message_data, channel_emails=channel_emails)
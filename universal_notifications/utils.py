@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from functools import lru_cache
+from itertools import islice
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import models
+from django.template import Template
+from django.utils.encoding import force_str
+
+
+def chunked(iterable, size):
+    """Yields lists of at most `size` items from any iterable (without materializing it)."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def serialize_instance(obj):
+    """Returns JSON serializable representation of obj - model instances are passed by primary key."""
+    if isinstance(obj, models.Model):
+        return {"__model__": obj._meta.label, "pk": obj.pk}
+    return obj
+
+
+def deserialize_instance(data):
+    if isinstance(data, dict) and "__model__" in data:
+        return apps.get_model(data["__model__"])._default_manager.get(pk=data["pk"])
+    return data
+
+
+def serialize_instances(objs):
+    """Returns JSON serializable representation of a list of model instances of the same model."""
+    objs = list(objs)
+    if not objs:
+        return {"__model__": None, "pks": []}
+    if not all(isinstance(obj, models.Model) for obj in objs):
+        raise ImproperlyConfigured("Only model instances can be passed to tasks as receivers")
+    return {"__model__": objs[0]._meta.label, "pks": [obj.pk for obj in objs]}
+
+
+def deserialize_instances(data):
+    if not data["pks"]:
+        return []
+    return list(apps.get_model(data["__model__"])._default_manager.filter(pk__in=data["pks"]))
+
+
+@lru_cache(maxsize=getattr(settings, "UNIVERSAL_NOTIFICATIONS_TEMPLATE_CACHE_SIZE", 256))
+def _compile_template(source):
+    return Template(source)
+
+
+def get_compiled_template(source):
+    """Returns compiled django Template for given template string (process-wide LRU cache).
+
+    Source is evaluated first, so lazy translations are cached separately for each language.
+    """
+    return _compile_template(force_str(source))
+
+
+def get_template_cache_info():
+    """Returns hits, misses, maxsize & currsize of the compiled templates cache."""
+    return _compile_template.cache_info()
+
+
+def clear_template_cache(**kwargs):
+    if kwargs.get("setting", "TEMPLATES") == "TEMPLATES":
+        _compile_template.cache_clear()
+
+
+setting_changed.connect(clear_template_cache)